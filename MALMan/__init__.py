@@ -20,7 +20,22 @@ app.config.update(
                                 'GIF', 'SVG', 'BMP', 'PDF'],
     UPLOADED_ATTACHMENTS_DEST=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attachments'),
     CHANGE_MSG='These values were updated: ',
-    ITEMS_PER_PAGE=1000
+    ITEMS_PER_PAGE=1000,
+    POS_TOKEN_MAX_AGE=15 * 60,  # seconds a bar terminal session token stays valid
+    POS_TOKEN_GENERATION=1,  # increase to revoke all issued session tokens
+    POS_TOKEN_REQUIRED=False,  # require a session token for purchases on a bar account
+    POS_TOKEN_OFFLINE_GRACE=12 * 60 * 60,  # seconds an expired token is accepted for buffered sales
+    SYNC_SEQUENCE_LAG=None,  # changes /api/sync returns again, None is 0 on SQLite and 100 otherwise
+    EVENT_BROKER='MALMan.events.SQLiteBroker',
+    EVENT_BROKER_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events.db'),
+    EVENT_RETENTION=60 * 60,  # seconds events are kept for terminals that reconnect
+    EVENT_STREAM_DURATION=30,  # seconds before an event stream is closed, the terminal reconnects
+    EVENT_POLL_INTERVAL=1,  # seconds between checks of the broker for new events
+    INSTRUMENTATION=False,  # log query counts and timings of every request, see logs.py
+    REQUEST_LOGPATH='requests.log',
+    SLOW_REQUEST_LOGPATH='slow_requests.log',
+    SLOW_REQUEST_THRESHOLD=500,  # ms
+    N_PLUS_ONE_THRESHOLD=10  # warn when a statement is repeated more often in a request
 )
 
 # set config values from config file (and overwrite defaults)
@@ -32,6 +47,8 @@ from MALMan import logs
 
 from MALMan import security
 
+from MALMan import events
+
 from MALMan import api
 
 from MALMan import views_my_account, views_members, views_bar, views_accounting, views_errors
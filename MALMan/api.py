@@ -1,42 +1,129 @@
 from MALMan import app
 import MALMan.database as DB
+from MALMan.events import get_broker
+from MALMan.view_utils import sales_period
 
 from flask import Response, request
 from flask_security.utils import verify_and_update_password
 from flask.ext.basicauth import BasicAuth
 
+from sqlalchemy.exc import IntegrityError
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
 import json
+import time
+import calendar
+import hashlib
 from datetime import datetime
 
 api_auth = BasicAuth(app)
 
+# the last response of list_stock, as an (etag, json) tuple
+_stock_cache = (None, None)
+
+
 @app.route("/api/stock")
 @api_auth.required
 def list_stock():
-    stock = DB.StockItem.query.filter_by(active=True).all()
-    items = [{'id': str(item.id),
-              'name': str(item.name),
-              'price': str(item.price),
-              'category': str(item.category.name)
-             } for item in stock]
-    return Response(json.dumps(items), mimetype='application/json')
+    """Return the active stock items.
+    The response is cached until the catalogue or stock version changes, and
+    supports conditional requests (ETag and Last-Modified)
+    """
+    global _stock_cache
+    versions = DB.get_versions('catalogue', 'stock')
+    etag = 'catalogue-%i-stock-%i' % (versions['catalogue'][0], versions['stock'][0])
+    cached_etag, cached_json = _stock_cache
+    if cached_etag != etag:
+        stock = DB.StockItem.query.options(*DB.LOAD_PROFILES['api']).filter_by(active=True).all()
+        levels = DB.stock_levels([item.id for item in stock])
+        items = [{'id': str(item.id),
+                  'name': str(item.name),
+                  'price': str(item.price),
+                  'category': str(item.category.name),
+                  'stock': str(levels[item.id])
+                 } for item in stock]
+        cached_json = json.dumps(items)
+        _stock_cache = (etag, cached_json)
+    response = Response(cached_json, mimetype='application/json')
+    response.set_etag(etag)
+    modified = [modified for version, modified in versions.values() if modified]
+    if modified:
+        response.last_modified = max(modified)
+    return response.make_conditional(request)
 
 
 @app.route("/api/user")
 @api_auth.required
 def list_users():
-    minimalprice = DB.StockItem.query.order_by(DB.StockItem.price).first()
-    users = DB.User.query.order_by(DB.User.name).all()
+    """Return the users that can afford the cheapest stock item"""
+    minimalprice = DB.db.session.query(DB.db.func.min(DB.StockItem.price)).as_scalar()
+    users = DB.bar_account_balances(minimum=minimalprice)
     userlist = [ {
-        'id': str(user.id),
-        'name': str(user.name)} for user in users if user.bar_account_balance > minimalprice.price ]
+        'id': str(user.user_id),
+        'name': str(user.name)} for user in users ]
     return Response(json.dumps(userlist), mimetype='application/json')
 
 
+def _token_serializer():
+    # the generation is part of the salt, so increasing it invalidates all tokens
+    salt = 'pos-session-%s' % app.config['POS_TOKEN_GENERATION']
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=salt)
+
+
+def _password_fingerprint(user):
+    # tokens contain this so they are revoked when the user changes their password
+    return hashlib.md5((user.password or '').encode('utf-8')).hexdigest()
+
+
+def _user_from_token(token, user_id, at=None):
+    """Return the user if the session token is valid for user_id, None otherwise.
+    If at is given the token has to be valid at that datetime instead of now,
+    which is used for sales that were buffered by a terminal until it expired.
+    Such a token is still only accepted until POS_TOKEN_OFFLINE_GRACE seconds
+    after it expired, whatever time the terminal claims the sale was made.
+    This only checks a HMAC signature, which is much cheaper than verifying a password.
+    """
+    if not token or not isinstance(token, basestring):
+        return None
+    max_age = app.config['POS_TOKEN_MAX_AGE']
+    if at:
+        max_age += app.config['POS_TOKEN_OFFLINE_GRACE']
+    try:
+        (token_user_id, fingerprint), signed_at = _token_serializer().loads(
+            token, max_age=max_age, return_timestamp=True)
+    except (BadSignature, ValueError, TypeError):
+        return None
+    if at:
+        # signed_at is in UTC, at in local time like the bar log
+        age = time.mktime(at.timetuple()) - calendar.timegm(signed_at.utctimetuple())
+        if not 0 <= age <= app.config['POS_TOKEN_MAX_AGE']:
+            return None
+    if token_user_id != user_id:
+        return None
+    user = DB.User.query.get(user_id)
+    if not user or _password_fingerprint(user) != fingerprint:
+        return None
+    return user
+
+
+def _purchase_allowed(user, token, sold_at=None):
+    """Whether a purchase on the user's bar account with the session token is allowed.
+    For a purchase sold_at a buffered sale, the token has to be valid at that time."""
+    if not app.config['POS_TOKEN_REQUIRED']:
+        return True
+    return _user_from_token(token, user.id, sold_at) is not None
+
+
 @app.route("/api/user/<int:user_id>")
 @api_auth.required
 def authenticate_user(user_id):
-    """Return the user's account balance if user and password match, return False otherwise"""
+    """Return the user's account balance if user and password (or session token) match,
+    return False otherwise"""
+    if 'token' in request.args:
+        user = _user_from_token(request.args['token'], user_id)
+        if not user:
+            return str(False)
+        return str(user.bar_account_balance)
     user = DB.User.query.get(user_id)
     if not user:
         return str(False)
@@ -45,15 +132,110 @@ def authenticate_user(user_id):
     return str(False)
 
 
+@app.route("/api/user/<int:user_id>/token")
+@api_auth.required
+def issue_token(user_id):
+    """Return a session token and the user's account balance if user and password match,
+    return False otherwise.
+    The token can be passed instead of the password to the other API calls until
+    it expires (see POS_TOKEN_MAX_AGE), so the password is only checked once.
+    """
+    user = DB.User.query.get(user_id)
+    if not user or not verify_and_update_password(request.args['password'], user):
+        return str(False)
+    # verify_and_update_password might have updated the password hash
+    DB.db.session.commit()
+    token = _token_serializer().dumps([user.id, _password_fingerprint(user)])
+    return Response(json.dumps({'token': token, 'balance': str(user.bar_account_balance)}),
+                    mimetype='application/json')
+
+
+def _register_purchases(sales):
+    """Add the sales to the bar log. sales is a list of
+    (item, quantity, user, datetime, idempotency_key) tuples, where all but the
+    first two may be None.
+    Sales to a user are also registered in the user's BarAccountLog, other
+    sales are registered as cash transactions.
+    Everything is added to the current DB transaction, the caller has to commit.
+    """
+    now = datetime.now()
+    log = [DB.BarLog(
+        item_id = item.id,
+        amount = -quantity,
+        price = item.price * quantity,
+        datetime = sold_at or now,
+        user_id = user.id if user else None,
+        transaction_type = "sale",
+        idempotency_key = idempotency_key)
+        for item, quantity, user, sold_at, idempotency_key in sales]
+    DB.db.session.add_all(log)
+    # flush to get the purchase ids without ending the DB transaction
+    DB.db.session.flush()
+
+    totals = {}
+    for purchase, (item, quantity, user, sold_at, idempotency_key) in zip(log, sales):
+        if user:
+            DB.db.session.add(DB.BarAccountLog(
+                user_id = user.id,
+                purchase_id = purchase.id))
+            totals[user] = totals.get(user, 0) + purchase.price
+        else:
+            DB.db.session.add(DB.CashTransaction(
+                purchase_id = purchase.id,
+                is_revenue = True,
+                amount = purchase.price,
+                description = "purchase",
+                datetime = purchase.datetime))
+    for user, total in totals.items():
+        user.add_to_bar_account(-total)
+    DB.bump_version('stock')
+
+
+def _valid_idempotency_key(key):
+    return isinstance(key, basestring) and 0 < len(key) <= 64
+
+
+def _existing_idempotency_keys(keys):
+    """Return the set of keys that were already used for a sale, invalid keys are ignored"""
+    keys = [key for key in keys if _valid_idempotency_key(key)]
+    if not keys:
+        return set()
+    existing = DB.db.session.query(DB.BarLog.idempotency_key) \
+        .filter(DB.BarLog.idempotency_key.in_(keys))
+    return set(key for key, in existing)
+
+
+def _parse_timestamp(timestamp):
+    """Convert a unix timestamp sent by a bar terminal to a datetime, None if it is missing.
+    Raises ValueError or OverflowError if it isn't a valid timestamp."""
+    if timestamp in (None, ''):
+        return None
+    return datetime.fromtimestamp(float(timestamp))
+
+
 @app.route("/api/purchase", methods=['POST'])
 @api_auth.required
 def purchase():
     """Register a purchase in the bar log.
-    If a userID is passed also register the purchase in the user's bar BarAccountLog.
+    If a userID is passed also register the purchase in the user's bar BarAccountLog,
+    this requires a session token if POS_TOKEN_REQUIRED is set.
     If no userID is passed register it as a cash transaction.
+    If an idempotency_key is passed that was already used, the purchase was
+    registered before and is not registered again.
+    A unix timestamp can be passed to register the time of the sale, without
+    one the sale is registered at the time of the request.
     """
     if not 'item_id' in request.form:
         return str(False)
+    try:
+        sold_at = _parse_timestamp(request.form.get('timestamp'))
+    except (ValueError, OverflowError):
+        return str(False)
+    idempotency_key = request.form.get('idempotency_key') or None
+    if idempotency_key and not _valid_idempotency_key(idempotency_key):
+        return str(False)
+    if _existing_idempotency_keys([idempotency_key]):
+        return str(True)
     item_id = int(request.form['item_id'])
     item = DB.StockItem.query.get(item_id)
     if not item:
@@ -61,35 +243,242 @@ def purchase():
     if 'user_id' in request.form:
         user_id = int(request.form['user_id'])
         user = DB.User.query.get(user_id)
-        if not user:
+        if not user or not _purchase_allowed(user, request.form.get('token')):
             return str(False)
     else:
-        user_id = None
+        user = None
 
-    purchase = DB.BarLog(
-        item_id = item.id,
-        amount = -1,
-        price = item.price,
-        user_id = user_id,
-        transaction_type = "sale")
-    DB.db.session.add(purchase)
+    _register_purchases([(item, 1, user, sold_at, idempotency_key)])
+    try:
+        DB.db.session.commit()
+    except IntegrityError:
+        # the same sale was registered by a concurrent request
+        DB.db.session.rollback()
+        return str(bool(_existing_idempotency_keys([idempotency_key])))
+
+    return str(True)
+
+
+@app.route("/api/purchase/batch", methods=['POST'])
+@api_auth.required
+def purchase_batch():
+    """Register several purchases of one user (or paid in cash) at once.
+    Pass item_id and quantity once for every item, in the same order.
+    Purchases on a bar account require a session token if POS_TOKEN_REQUIRED is set.
+    They are registered at the time of the request.
+    All purchases are registered in a single DB transaction: if one of them is
+    invalid nothing is registered and False is returned.
+    Otherwise the user's new balance is returned (null for cash purchases).
+    """
+    try:
+        item_ids = [int(item_id) for item_id in request.form.getlist('item_id')]
+        quantities = [int(quantity) for quantity in request.form.getlist('quantity')]
+        user_id = int(request.form['user_id']) if 'user_id' in request.form else None
+    except ValueError:
+        return str(False)
+    if not item_ids or len(item_ids) != len(quantities) or min(quantities) < 1:
+        return str(False)
+    items = DB.StockItem.query.filter(DB.StockItem.id.in_(item_ids)).all()
+    items = dict((item.id, item) for item in items)
+    if len(items) != len(set(item_ids)):
+        return str(False)
+    if user_id is not None:
+        user = DB.User.query.get(user_id)
+        if not user or not _purchase_allowed(user, request.form.get('token')):
+            return str(False)
+    else:
+        user = None
+
+    _register_purchases([(items[item_id], quantity, user, None, None)
+                         for item_id, quantity in zip(item_ids, quantities)])
     DB.db.session.commit()
 
-    if user_id != None:
-        transaction = DB.BarAccountLog(
-            user_id = user.id,
-            purchase_id = purchase.id)
-        DB.db.session.add(transaction)
-        DB.db.session.commit()
+    balance = str(user.bar_account_balance) if user else None
+    return Response(json.dumps({'balance': balance}), mimetype='application/json')
+
+
+def _sale_ids(sales, field):
+    """Return the set of ids in field of the flushed sales, values that aren't ids are skipped"""
+    ids = set()
+    for sale in sales:
+        try:
+            ids.add(int(sale[field]))
+        except (KeyError, TypeError, ValueError, OverflowError):
+            pass
+    return ids
+
+
+@app.route("/api/purchase/flush", methods=['POST'])
+@api_auth.required
+def purchase_flush():
+    """Register the sales a bar terminal buffered while the server was unreachable.
+    The request body is a JSON list of sales, each an object with an
+    idempotency_key, an item_id, a unix timestamp of the sale and optionally
+    a quantity (default 1) and a user_id (cash sale if missing). Sales without
+    a timestamp are rejected.
+    If POS_TOKEN_REQUIRED is set a sale on a bar account needs the session
+    token it was made with. The token has to be valid at the time of the sale,
+    and may have expired since, as long as that was less than
+    POS_TOKEN_OFFLINE_GRACE seconds ago.
+    Sales whose idempotency_key was already used are skipped, so a terminal
+    can safely send the same sales again. The valid sales are registered in a
+    single DB transaction.
+    Returns the keys of the registered, duplicate and rejected sales as JSON.
+    """
+    sales = request.get_json(force=True, silent=True)
+    if not isinstance(sales, list):
+        return str(False)
+    existing = _existing_idempotency_keys([sale.get('idempotency_key') for sale in sales
+                                           if isinstance(sale, dict)])
+    item_ids = _sale_ids(sales, 'item_id')
+    user_ids = _sale_ids(sales, 'user_id')
+    items = DB.StockItem.query.filter(DB.StockItem.id.in_(item_ids)).all()
+    items = dict((item.id, item) for item in items)
+    users = DB.User.query.filter(DB.User.id.in_(user_ids)).all()
+    users = dict((user.id, user) for user in users)
+
+    result = {'registered': [], 'duplicate': [], 'rejected': []}
+    valid = []
+    for sale in sales:
+        key = sale.get('idempotency_key') if isinstance(sale, dict) else None
+        if not _valid_idempotency_key(key):
+            result['rejected'].append(key)
+            continue
+        if key in existing:
+            result['duplicate'].append(key)
+            continue
+        try:
+            item = items[int(sale['item_id'])]
+            user = users[int(sale['user_id'])] if sale.get('user_id') is not None else None
+            quantity = int(sale.get('quantity', 1))
+            sold_at = _parse_timestamp(sale.get('timestamp'))
+        except (KeyError, TypeError, ValueError, OverflowError):
+            result['rejected'].append(key)
+            continue
+        # registering a buffered sale at the time of the flush could be hours off
+        if sold_at is None or quantity < 1 or (user and not _purchase_allowed(user, sale.get('token'), sold_at)):
+            result['rejected'].append(key)
+            continue
+        existing.add(key)
+        valid.append((item, quantity, user, sold_at, key))
+        result['registered'].append(key)
+
+    if valid:
+        _register_purchases(valid)
+        try:
+            DB.db.session.commit()
+        except IntegrityError:
+            # some of these sales were registered by a concurrent request,
+            # the terminal can send them again to find out which
+            DB.db.session.rollback()
+            return str(False)
+
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@app.route("/api/sync")
+@api_auth.required
+def sync():
+    """Return the users and stock items that changed since the change sequence
+    number passed as since, or all of them if since is 0 or missing.
+    The response contains the current sequence number, which the terminal
+    passes as since the next time. If the changes since then were pruned (see
+    prune_sync_changes) all of them are returned as well.
+    On databases with concurrent writers (MySQL) a change can be committed after
+    one with a higher sequence number, so the last SYNC_SEQUENCE_LAG changes
+    before since are returned again to catch those.
+    """
+    since = request.args.get('since', 0, type=int)
+    seq, oldest = DB.db.session.query(DB.db.func.max(DB.SyncChange.id), DB.db.func.min(DB.SyncChange.id)).one()
+    seq = seq or 0
+    if oldest and since < oldest - 1:
+        since = 0
+    lag = app.config['SYNC_SEQUENCE_LAG']
+    if lag is None:
+        # SQLite has a single writer, so its sequence numbers are committed in order
+        lag = 0 if DB.db.engine.dialect.name == 'sqlite' else 100
+    users = DB.User.query
+    items = DB.StockItem.query.options(*DB.LOAD_PROFILES['api'])
+    if since:
+        changes = DB.db.session.query(DB.SyncChange.kind, DB.SyncChange.object_id) \
+            .filter(DB.SyncChange.id > since - lag, DB.SyncChange.id <= seq).distinct().all()
+        user_ids = [object_id for kind, object_id in changes if kind == 'user']
+        item_ids = [object_id for kind, object_id in changes if kind == 'item']
+        users = users.filter(DB.User.id.in_(user_ids)).all() if user_ids else []
+        items = items.filter(DB.StockItem.id.in_(item_ids)).all() if item_ids else []
     else:
-        transaction = DB.CashTransaction(
-            purchase_id = purchase.id,
-            is_revenue = True,
-            amount = item.price,
-            description = "purchase",
-            datetime = datetime.now())
-        DB.db.session.add(transaction)
-        DB.db.session.commit()
+        users = users.all()
+        items = items.all()
+    levels = DB.stock_levels([item.id for item in items])
+    data = {
+        'seq': seq,
+        'users': [{'id': str(user.id),
+                   'name': str(user.name),
+                   'balance': str(user.bar_account_balance or 0)
+                  } for user in users],
+        'items': [{'id': str(item.id),
+                   'name': str(item.name),
+                   'price': str(item.price),
+                   'category': str(item.category.name),
+                   'active': bool(item.active),
+                   'stock': str(levels[item.id])
+                  } for item in items]}
+    return Response(json.dumps(data), mimetype='application/json')
 
-    return str(True)
 
+@app.route("/api/stats")
+@api_auth.required
+def stats():
+    """Return the sales per stock item and per day from start until end (yyyy-mm-dd, end excluded),
+    by default of the last 30 days. Only the daily rollup is read, so any period is cheap."""
+    start, end = sales_period()
+    data = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'items': [{'id': str(item.item_id),
+                   'name': item.name,
+                   'sold': int(item.sold),
+                   'revenue': str(item.revenue)
+                  } for item in DB.sales_per_item(start, end)],
+        'days': [{'day': str(day.day),
+                  'sold': int(day.sold),
+                  'revenue': str(day.revenue)
+                 } for day in DB.sales_per_day(start, end)]}
+    return Response(json.dumps(data), mimetype='application/json')
+
+
+@app.route("/api/events")
+@api_auth.required
+def stream_events():
+    """Stream change events to a bar terminal as server-sent events.
+    The event types are 'catalogue' and 'stock' (reload /api/stock), 'balance'
+    (the data holds the user_id whose balance changed) and 'accounting'.
+    The stream is closed after EVENT_STREAM_DURATION seconds so it doesn't keep
+    a worker busy forever; the terminal reconnects and passes the id of the last
+    event it received in the Last-Event-ID header (or the since parameter) to get
+    the events it missed in between.
+    """
+    broker = get_broker()
+    last_id = request.args.get('since', type=int)
+    try:
+        last_id = int(request.headers['Last-Event-ID'])
+    except (KeyError, ValueError):
+        pass
+    if last_id is None:
+        last_id = broker.last_id()
+    duration = app.config['EVENT_STREAM_DURATION']
+    interval = app.config['EVENT_POLL_INTERVAL']
+
+    def stream(last_id):
+        end = time.time() + duration
+        yield 'retry: %i\n\n' % (interval * 1000)
+        while True:
+            for event_id, topic, data in broker.since(last_id):
+                yield 'id: %i\nevent: %s\ndata: %s\n\n' % (event_id, topic, json.dumps(data))
+                last_id = event_id
+            if time.time() >= end:
+                break
+            time.sleep(interval)
+
+    return Response(stream(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
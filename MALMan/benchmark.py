@@ -0,0 +1,392 @@
+"""Seed a synthetic dataset and time MALMan's hot paths
+
+This is used by the bench command in commands.py. Never point it at a
+database that holds real data, seeding starts by dropping all tables.
+"""
+
+from MALMan import app
+import MALMan.database as DB
+
+from flask_security.utils import encrypt_password
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+import base64
+import datetime
+import json
+import math
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+
+BENCH_EMAIL = 'bench@example.com'
+BENCH_PASSWORD = 'benchmark'
+MEMBER_PASSWORD = 'member'
+
+# (url, whether it needs the API's basic auth), the bench user has id 1
+BENCHMARKS = [
+    ('/api/stock', True),
+    ('/api/user', True),
+    ('/api/user/1?password=' + BENCH_PASSWORD, True),
+    ('/api/sync', True),
+    ('/bar', False),
+    ('/bar/log', False),
+    ('/bar/log/page/50', False),
+    ('/bar/stats', False),
+    ('/bar/stats?start=2000-01-01', False),
+    ('/api/stats?start=2000-01-01', True),
+    ('/accounting', False),
+    ('/accounting/log', False),
+    ('/accounting/cashlog', False),
+    ('/accounting/cashlog/page/20', False),
+    ('/accounting/membershipfees', False),
+    ('/accounting/overdue_membershipfees', False),
+    ('/accounting/kasboek', False),
+    ('/accounting/dagboek', False),
+    ('/members', False),
+]
+
+# the maximum number of queries per url, independent of the size of the dataset,
+# bench reports the urls going over it (e.g. a template loading a relationship per row)
+QUERY_BUDGETS = {
+    '/api/stock': 4,
+    '/api/user': 3,
+    '/api/user/1?password=' + BENCH_PASSWORD: 3,
+    '/api/sync': 6,
+    '/bar': 5,
+    '/bar/log': 5,
+    '/bar/log/page/50': 5,
+    '/bar/stats': 4,
+    '/bar/stats?start=2000-01-01': 4,
+    '/api/stats?start=2000-01-01': 3,
+    '/accounting': 4,
+    '/accounting/log': 8,
+    '/accounting/cashlog': 5,
+    '/accounting/cashlog/page/20': 5,
+    '/accounting/membershipfees': 6,
+    '/accounting/overdue_membershipfees': 3,
+    '/accounting/kasboek': 8,
+    '/accounting/dagboek': 8,
+    '/members': 6,
+}
+
+_CHUNK = 10000
+
+
+class QueryCounter(object):
+    """Count the SQL statements executed while the counter is used as a context manager"""
+
+    def __init__(self):
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(DB.db.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(DB.db.engine, 'before_cursor_execute', self._count)
+
+
+def _insert(model, rows):
+    """Insert the rows (dicts) into the model's table using executemany, in chunks"""
+    for start in xrange(0, len(rows), _CHUNK):
+        DB.db.session.execute(model.__table__.insert(), rows[start:start + _CHUNK])
+
+
+def _random_datetime(rng, start, end):
+    return start + datetime.timedelta(seconds=rng.randint(0, int((end - start).total_seconds())))
+
+
+def seed(members=2000, purchases=200000, transactions=20000, years=5, seed=0):
+    """Fill an empty database (with the default data of init_database) with a
+    reproducible synthetic dataset"""
+    rng = random.Random(seed)
+    end = datetime.datetime.now()
+    start = end.replace(year=end.year - years)
+
+    # the bench user can see every page, all other members share one password
+    # because encrypting passwords is slow
+    DB.user_datastore.create_user(email=BENCH_EMAIL, name='bench', active=True,
+                                  password=encrypt_password(BENCH_PASSWORD),
+                                  roles=['members', 'bar', 'finances'],
+                                  confirmed_at=start.date(), membership_start=start.date())
+    DB.db.session.commit()
+    password = encrypt_password(MEMBER_PASSWORD)
+    _insert(DB.User, [{'id': user_id,
+                       'email': 'member%i@example.com' % user_id,
+                       'name': 'member %i' % user_id,
+                       'password': password,
+                       'active': True,
+                       'confirmed_at': start.date(),
+                       'membership_start': _random_datetime(rng, start, end).date()}
+                      for user_id in xrange(2, members + 2)])
+    user_ids = range(1, members + 2)
+
+    items = [{'id': item_id,
+              'name': 'item %i' % item_id,
+              'stock_max': 48,
+              'price': rng.choice([0.5, 1, 1.5, 2, 2.5, 3]),
+              'category_id': rng.randint(1, 3),
+              'josto': item_id % 2 == 0,
+              'active': True} for item_id in xrange(1, 41)]
+    _insert(DB.StockItem, items)
+
+    categories = DB.AccountingCategory.query.all()
+    revenue_categories = [category.id for category in categories if category.is_revenue]
+    expense_categories = [category.id for category in categories if not category.is_revenue]
+    topup_category = DB.AccountingCategory.query.filter_by(name='Aanvullen drankrekening').first().id
+    statement_numbers = {1: 0, 2: 0, 99: 0}
+    transaction_rows = []
+    topups = []
+    fees = []
+    for transaction_id in xrange(1, transactions + 1):
+        date = _random_datetime(rng, start, end).date()
+        bank_id = rng.choice([1, 1, 2, 99])
+        statement_numbers[bank_id] += 1
+        is_revenue = rng.random() < 0.7
+        category_id = rng.choice(revenue_categories if is_revenue else expense_categories)
+        if transaction_id % 4 == 0:
+            category_id, is_revenue = topup_category, True
+            topups.append({'user_id': rng.choice(user_ids), 'transaction_id': transaction_id})
+        elif transaction_id % 10 == 1:
+            fees.append({'user_id': rng.choice(user_ids), 'transaction_id': transaction_id,
+                         'until': date + datetime.timedelta(days=rng.choice([31, 92, 365]))})
+        transaction_rows.append({'id': transaction_id,
+                                 'date': date,
+                                 'facturation_date': date,
+                                 'date_filed': date,
+                                 'is_revenue': is_revenue,
+                                 'amount': rng.randint(100, 20000) / 100.0,
+                                 'to_from': 'someone',
+                                 'description': 'transaction %i' % transaction_id,
+                                 'category_id': category_id,
+                                 'bank_id': bank_id,
+                                 'bank_statement_number': statement_numbers[bank_id],
+                                 'filed_by_id': 1})
+    _insert(DB.Transaction, transaction_rows)
+    _insert(DB.BarAccountLog, topups)
+    _insert(DB.MembershipFee, fees)
+    del transaction_rows, topups, fees
+
+    log = []
+    account_log = []
+    cash_log = []
+    for purchase_id in xrange(1, purchases + 1):
+        item = rng.choice(items)
+        sold_at = _random_datetime(rng, start, end)
+        if purchase_id % 50 == 0:
+            log.append({'id': purchase_id, 'item_id': item['id'], 'amount': 48, 'price': 0,
+                        'datetime': sold_at, 'user_id': 1, 'transaction_type': 'stock up'})
+            continue
+        user_id = rng.choice(user_ids) if rng.random() < 0.7 else None
+        log.append({'id': purchase_id, 'item_id': item['id'], 'amount': -1, 'price': item['price'],
+                    'datetime': sold_at, 'user_id': user_id, 'transaction_type': 'sale'})
+        if user_id:
+            account_log.append({'user_id': user_id, 'purchase_id': purchase_id})
+        else:
+            cash_log.append({'purchase_id': purchase_id, 'is_revenue': True, 'amount': item['price'],
+                             'description': 'purchase', 'datetime': sold_at})
+    _insert(DB.BarLog, log)
+    _insert(DB.BarAccountLog, account_log)
+    _insert(DB.CashTransaction, cash_log)
+    del log, account_log, cash_log
+
+    balances = DB.bar_account_balances().all()
+    DB.db.session.execute(DB.User.__table__.update()
+                          .where(DB.User.__table__.c.id == DB.db.bindparam('user_id'))
+                          .values(bar_account_balance=DB.db.bindparam('balance')),
+                          [{'user_id': row.user_id, 'balance': row.balance} for row in balances])
+    paid_until = DB.db.session.query(DB.membership_paid_until()).all()
+    DB.db.session.execute(DB.User.__table__.update()
+                          .where(DB.User.__table__.c.id == DB.db.bindparam('user_id'))
+                          .values(membership_paid_until=DB.db.bindparam('until')),
+                          [{'user_id': row.user_id, 'until': row.until} for row in paid_until])
+    DB.rebuild_daily_rollup()
+    DB.db.session.commit()
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of values"""
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def _api_headers():
+    credentials = '%s:%s' % (app.config['BASIC_AUTH_USERNAME'], app.config['BASIC_AUTH_PASSWORD'])
+    return {'Authorization': 'Basic ' + base64.b64encode(credentials)}
+
+
+def run(repeat=20, benchmarks=BENCHMARKS):
+    """Request every benchmark url repeat times (after one warm-up request) and
+    return a dict with the status, latency percentiles in ms, query count and query budget per url"""
+    app.config['TESTING'] = True
+    app.config['CSRF_ENABLED'] = False
+    app.config['WTF_CSRF_ENABLED'] = False
+    api_headers = _api_headers()
+    results = {}
+    with app.test_client() as client:
+        client.post('/login', data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+        for url, api in benchmarks:
+            headers = api_headers if api else {}
+            client.get(url, headers=headers)
+            timings = []
+            queries = []
+            for i in xrange(repeat):
+                with QueryCounter() as counter:
+                    started = time.time()
+                    response = client.get(url, headers=headers)
+                    timings.append((time.time() - started) * 1000)
+                queries.append(counter.count)
+            results[url] = {'status': response.status_code,
+                            'p50_ms': round(_percentile(timings, 50), 2),
+                            'p95_ms': round(_percentile(timings, 95), 2),
+                            'mean_ms': round(sum(timings) / len(timings), 2),
+                            'queries': max(queries),
+                            'query_budget': QUERY_BUDGETS.get(url)}
+    return results
+
+
+def over_budget(results):
+    """Return a line for every url in results that ran more queries than its budget"""
+    return ['%s: %i queries, the budget is %i' % (url, result['queries'], result['query_budget'])
+            for url, result in sorted(results.items())
+            if result.get('query_budget') is not None and result['queries'] > result['query_budget']]
+
+
+def compare(baseline, results):
+    """Return a line for every url in both results, comparing their p50, p95 and query count"""
+    lines = []
+    for url in sorted(set(baseline) & set(results)):
+        old, new = baseline[url], results[url]
+        change = (new['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+        lines.append('%s: p50 %.2f -> %.2f ms (%+.0f%%), p95 %.2f -> %.2f ms, queries %i -> %i' %
+                     (url, old['p50_ms'], new['p50_ms'], change, old['p95_ms'], new['p95_ms'],
+                      old['queries'], new['queries']))
+    return lines
+
+
+def synthetic_trace(sales=1000, seed=0):
+    """Return a list of (user_id, item_id) sales of active items, 30% of them cash sales
+    (user_id None). The bench user is left out because it has a different password."""
+    rng = random.Random(seed)
+    user_ids = [user_id for user_id, in DB.db.session.query(DB.User.id).filter(DB.User.email != BENCH_EMAIL)]
+    item_ids = [item_id for item_id, in DB.db.session.query(DB.StockItem.id).filter_by(active=True)]
+    return [(rng.choice(user_ids) if rng.random() < 0.7 else None, rng.choice(item_ids))
+            for i in xrange(sales)]
+
+
+def _timed(records, name, method, url, **kwargs):
+    """Do a request, record (name, latency in ms, outcome) and return the response
+    (None if the request raised an exception)"""
+    started = time.time()
+    response = None
+    try:
+        response = method(url, **kwargs)
+        outcome = 'ok' if response.status_code == 200 and response.data != 'False' else 'failed'
+    except OperationalError as e:
+        # 'database is locked' on SQLite, lock wait timeouts and deadlocks on MySQL
+        outcome = 'locked' if 'lock' in str(e).lower() else 'error'
+    except Exception:
+        outcome = 'error'
+    records.append((name, (time.time() - started) * 1000, outcome))
+    return response
+
+
+def _terminal(sales, password, use_tokens):
+    """Play the sales like a bar terminal: check the member's balance, then
+    register the purchase. Return the records of all requests and the
+    idempotency keys of the purchases the server acknowledged."""
+    headers = _api_headers()
+    records = []
+    acknowledged = []
+    tokens = {}
+    client = app.test_client()
+    for user_id, item_id in sales:
+        data = {'item_id': item_id, 'idempotency_key': uuid.uuid4().hex}
+        if user_id:
+            data['user_id'] = user_id
+            if use_tokens and user_id in tokens:
+                _timed(records, 'balance', client.get, '/api/user/%i?token=%s' % (user_id, tokens[user_id]),
+                       headers=headers)
+            elif use_tokens:
+                response = _timed(records, 'token', client.get, '/api/user/%i/token?password=%s' %
+                                  (user_id, password), headers=headers)
+                if response is not None and response.data.startswith('{'):
+                    tokens[user_id] = json.loads(response.data)['token']
+            else:
+                _timed(records, 'balance', client.get, '/api/user/%i?password=%s' % (user_id, password),
+                       headers=headers)
+        response = _timed(records, 'purchase', client.post, '/api/purchase', data=data, headers=headers)
+        if response is not None and response.data == 'True':
+            acknowledged.append(data['idempotency_key'])
+    return records, acknowledged
+
+
+def _process_terminal(args):
+    return _terminal(*args)
+
+
+def _process_init():
+    # connections inherited from the parent process can't be shared
+    DB.db.engine.dispose()
+
+
+def load(trace, terminals=4, processes=False, password=MEMBER_PASSWORD, use_tokens=False):
+    """Replay the trace of (user_id, item_id) sales with concurrent terminals, using
+    threads or processes, and return throughput, latency and error statistics"""
+    app.config['TESTING'] = True
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    shares = [(trace[i::terminals], password, use_tokens) for i in xrange(terminals)]
+    started = time.time()
+    if processes:
+        pool = multiprocessing.Pool(terminals, initializer=_process_init)
+        outputs = pool.map(_process_terminal, shares)
+        pool.close()
+        pool.join()
+    else:
+        outputs = [None] * terminals
+
+        def play(index):
+            outputs[index] = _terminal(*shares[index])
+        threads = [threading.Thread(target=play, args=(i,)) for i in xrange(terminals)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.time() - started
+
+    records = [record for output in outputs for record in output[0]]
+    acknowledged = [key for output in outputs for key in output[1]]
+    registered = 0
+    for start in xrange(0, len(acknowledged), 500):
+        registered += DB.BarLog.query.filter(
+            DB.BarLog.idempotency_key.in_(acknowledged[start:start + 500])).count()
+    DB.db.session.remove()
+
+    report = {'terminals': terminals,
+              'mode': 'processes' if processes else 'threads',
+              'sales': len(trace),
+              'seconds': round(elapsed, 2),
+              'requests_per_second': round(len(records) / elapsed, 2),
+              'sales_per_second': round(len(acknowledged) / elapsed, 2),
+              'acknowledged': len(acknowledged),
+              'lost_purchases': len(acknowledged) - registered,
+              'requests': {}}
+    for name in sorted(set(record[0] for record in records)):
+        timings = [latency for record_name, latency, outcome in records if record_name == name]
+        outcomes = [outcome for record_name, latency, outcome in records if record_name == name]
+        report['requests'][name] = {'count': len(timings),
+                                    'p50_ms': round(_percentile(timings, 50), 2),
+                                    'p95_ms': round(_percentile(timings, 95), 2),
+                                    'p99_ms': round(_percentile(timings, 99), 2),
+                                    'max_ms': round(max(timings), 2),
+                                    'failed': outcomes.count('failed'),
+                                    'database_locked': outcomes.count('locked'),
+                                    'errors': outcomes.count('error')}
+    return report
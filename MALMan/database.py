@@ -7,8 +7,13 @@ try:
 except ImportError:
     from flask_sqlalchemy import SQLAlchemy
 import datetime
+import sqlite3
 
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, func, case, event, extract, text
+from sqlalchemy.orm import Session, joinedload, subqueryload
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.util import KeyedTuple
 from sqlalchemy.ext.hybrid import hybrid_property
 
 def _date_to_datetime(date):
@@ -22,6 +27,14 @@ def _date_to_datetime(date):
 
 db = SQLAlchemy(app)
 
+
+def record_change(topic, data=None):
+    '''Record a change in the current DB transaction.
+    The changes are published to the bar terminals when the transaction is committed,
+    see events.py'''
+    db.session.info.setdefault('changes', []).append((topic, data or {}))
+
+
 roles_users = db.Table('members_roles_users',
         db.Column('user_id', db.Integer(), db.ForeignKey('members.id')),
         db.Column('role_id', db.Integer(), db.ForeignKey('members_roles.id')))
@@ -51,7 +64,7 @@ class User(db.Model, UserMixin):
     city = db.Column(db.String(255))
     date_of_birth = db.Column(db.Date())
     telephone = db.Column(db.String(255))
-    membership_start = db.Column(db.Date())
+    membership_start = db.Column(db.Date(), index=True)
     membership_end = db.Column(db.Date())
     membership_dues = db.Column(db.Numeric(5, 2), default=0)
     password = db.Column(db.String(255))
@@ -60,28 +73,38 @@ class User(db.Model, UserMixin):
     show_email = db.Column(db.Boolean())
     motivation = db.Column(db.Text())
     confirmed_at = db.Column(db.Date())
+    bar_account_balance = db.Column(db.Numeric(10, 2), default=0)
+        # kept up to date by every write to bar_accounts_log, see add_to_bar_account
+    membership_paid_until = db.Column(db.Date())
+        # the until of the user's latest membership fee, see pay_membership_until
     roles = db.relationship('Role', secondary=roles_users,
         backref=db.backref('Roleusers', lazy='dynamic'))
 
     def __str__(self):
         return '<User id=%s email=%s>' % (self.id, self.email)
 
-    @property
-    def bar_account_balance(self):
-        total = 0
-        for item in self.bar_account_log:
-            if item.purchase_id:
-                total -= item.purchase.price
-            else:
-                total += item.transaction.amount
-        return total
+    def add_to_bar_account(self, amount):
+        '''Change the stored bar account balance by amount.
+
+        The change is done by the database (balance = balance + amount) when the
+        session is flushed, so it is part of the same DB transaction as the
+        BarAccountLog change that causes it. Changes made before the flush are
+        added up in the pending expression.
+        '''
+        balance = self.bar_account_balance
+        if not isinstance(balance, ClauseElement):
+            balance = func.coalesce(User.bar_account_balance, 0)
+        self.bar_account_balance = balance + amount
+        record_change('balance', {'user_id': self.id})
+
+    def pay_membership_until(self, until):
+        '''Update the stored membership_paid_until for a new membership fee paying until until'''
+        if self.membership_paid_until is None or until > self.membership_paid_until:
+            self.membership_paid_until = until
 
     @property
     def membership_due(self):
-    	for item in self.Membership_Fee:
-    	    #This will only be excecuted once, but this replaces a complicated if-construction
-            return item.until
-        return "0000-00-00"
+        return self.membership_paid_until or "0000-00-00"
 
     @hybrid_property
     def active_member(self):
@@ -120,7 +143,7 @@ class MembershipFee(db.Model):
     __tablename__ = 'members_fees'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('members.id'))
-    user = db.relationship('User', backref=db.backref("Membership_Fee", order_by="desc(MembershipFee.until)"), lazy="joined")
+    user = db.relationship('User', backref=db.backref("Membership_Fee", order_by="desc(MembershipFee.until)"))
     transaction_id = db.Column(db.Integer, db.ForeignKey('accounting_transactions.id'))
     transaction = db.relationship('Transaction')
     until = db.Column(db.Date())
@@ -134,15 +157,15 @@ class StockItem(db.Model):
     stock_max = db.Column(db.Integer)
     price = db.Column(db.Numeric(5, 2))
     category_id = db.Column(db.Integer, db.ForeignKey('bar_categories.id'))
-    category = db.relationship("StockCategory", backref="dranken", lazy="joined")
+    category = db.relationship("StockCategory", backref="dranken")
     josto = db.Column(db.Boolean())
     purchases = db.relationship("BarLog", backref="Drank")
     active = db.Column(db.Boolean())
 
     @property
     def stock(self):
-        # this might be improved
-        return sum(item.amount for item in self.purchases)
+        '''The current stock level. Use stock_levels() when the stock of several items is needed'''
+        return stock_levels([self.id]).get(self.id, 0)
 
     @property
     def stockup(self):
@@ -167,18 +190,131 @@ class BarLog(db.Model):
     __tablename__ = 'bar_log'
     id = db.Column(db.Integer, primary_key=True)
     item_id = db.Column(db.Integer, db.ForeignKey('bar_items.id'))
-    item = db.relationship("StockItem", backref="BarLog", lazy="joined")
+    item = db.relationship("StockItem", backref="BarLog")
     amount = db.Column(db.Integer)
     price = db.Column(db.Numeric(5, 2), default=0)
     datetime = db.Column(db.DateTime())
     user_id = db.Column(db.Integer, db.ForeignKey('members.id'))
     user = db.relationship('User')
     transaction_type = db.Column(db.String(50))
+    idempotency_key = db.Column(db.String(64), unique=True)
+        # generated by the bar terminal for each sale, so retried sales are only registered once
+    __table_args__ = (
+        db.Index('ix_bar_log_item_id_id', 'item_id', 'id'),
+            # stock levels sum the rows of an item after its latest snapshot
+        db.Index('ix_bar_log_datetime_id', 'datetime', 'id'),
+            # the stock log is sorted on these
+    )
 
     def __repr__(self):
         return '<id %r>' % self.id
 
 
+class StockSnapshot(db.Model):
+    """Define the bar_stock_snapshots database table"""
+    __tablename__ = 'bar_stock_snapshots'
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('bar_items.id'))
+    item = db.relationship("StockItem")
+    amount = db.Column(db.Integer)
+        # the stock level after all bar_log rows up to and including last_log_id
+    last_log_id = db.Column(db.Integer)
+    datetime = db.Column(db.DateTime())
+    __table_args__ = (
+        db.Index('ix_bar_stock_snapshots_item_id_id', 'item_id', 'id'),
+            # to find the latest snapshot of each item
+    )
+
+
+class BarDailyRollup(db.Model):
+    """Define the bar_daily_rollup database table"""
+    __tablename__ = 'bar_daily_rollup'
+    day = db.Column(db.Date(), primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('bar_items.id'), primary_key=True, autoincrement=False)
+    item = db.relationship("StockItem")
+    transaction_type = db.Column(db.String(50), primary_key=True)
+    amount = db.Column(db.Integer, default=0)
+        # the sum of the amounts of the bar_log rows of that day, item and type
+    revenue = db.Column(db.Numeric(10, 2), default=0)
+        # the sum of their prices
+    # kept up to date by update_daily_rollup, rebuilt by rebuild_daily_rollup
+
+
+class Version(db.Model):
+    """Define the cache_versions database table"""
+    __tablename__ = 'cache_versions'
+    name = db.Column(db.String(50), primary_key=True)
+        # what is versioned, e.g. 'catalogue' for the stock items
+    version = db.Column(db.Integer, default=0)
+    modified = db.Column(db.DateTime())
+        # in UTC, used for Last-Modified headers
+
+
+class SchemaMigration(db.Model):
+    """Define the schema_migrations database table"""
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+        # the version of the migration in MALMan.schema that was applied
+    description = db.Column(db.String(256))
+    applied = db.Column(db.DateTime())
+
+
+class SyncChange(db.Model):
+    """Define the sync_changes database table"""
+    __tablename__ = 'sync_changes'
+    id = db.Column(db.Integer, primary_key=True)
+        # the change sequence number the bar terminals sync from
+    kind = db.Column(db.String(20))
+        # 'user' or 'item'
+    object_id = db.Column(db.Integer)
+
+
+# the attributes /api/sync returns, changes to other attributes aren't recorded
+SYNCED_ATTRIBUTES = {
+    User: ('name', 'bar_account_balance'),
+    StockItem: ('name', 'price', 'category', 'category_id', 'active'),
+    BarLog: ('item_id', 'amount'),
+}
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_sync_changes(session, flush_context, instances):
+    # new objects only get an id during the flush, so the SyncChanges are added after it
+    modified = [obj for obj in session.dirty
+                if any(get_history(obj, name).has_changes() for name in SYNCED_ATTRIBUTES.get(type(obj), ()))]
+    session.info['sync_objects'] = list(session.new) + modified + list(session.deleted)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_sync_changes(session, flush_context):
+    '''Add a SyncChange for every user and stock item changed by this flush.
+    Stock items also change when bar_log rows are added or removed, because
+    their stock level changes.'''
+    changes = set()
+    for obj in session.info.pop('sync_objects', []):
+        if isinstance(obj, User):
+            changes.add(('user', obj.id))
+        elif isinstance(obj, StockItem):
+            changes.add(('item', obj.id))
+        elif isinstance(obj, BarLog) and obj.item_id:
+            changes.add(('item', int(obj.item_id)))
+    if changes:
+        session.execute(SyncChange.__table__.insert(),
+                        [{'kind': kind, 'object_id': object_id} for kind, object_id in sorted(changes)])
+
+
+def prune_sync_changes(keep):
+    '''Delete all but the newest keep SyncChanges, returns the number of deleted rows.
+    The newest one is always kept, so its sequence number isn't reused. Bar terminals
+    that last synced before the oldest kept change get all users and stock items.
+    The caller is responsible for committing.'''
+    newest = db.session.query(func.max(SyncChange.id)).scalar()
+    if newest is None:
+        return 0
+    return SyncChange.query.filter(SyncChange.id <= newest - max(keep, 1)) \
+        .delete(synchronize_session=False)
+
+
 class Bank(db.Model):
     """Define the acounting_banks database table"""
     __tablename__ = 'accounting_banks'
@@ -201,8 +337,8 @@ class CashTransaction(db.Model):
     """Define the acounting_cashregister database table"""
     __tablename__ = 'accounting_cashregister'
     id = db.Column(db.Integer, primary_key=True)
-    purchase_id = db.Column(db.Integer, db.ForeignKey('bar_log.id'))
-    purchase = db.relationship('BarLog', backref="cash_transaction", lazy="joined")
+    purchase_id = db.Column(db.Integer, db.ForeignKey('bar_log.id'), index=True)
+    purchase = db.relationship('BarLog', backref="cash_transaction")
     is_revenue = db.Column(db.Boolean())
     amount = db.Column(db.Numeric(10, 2))
     description = db.Column(db.Text())
@@ -243,7 +379,7 @@ class Transaction(db.Model):
         # date the bank transaction took place
     advance_date = db.Column(db.Date())
         # only applicable if the money was advanced
-    facturation_date = db.Column(db.Date())
+    facturation_date = db.Column(db.Date(), index=True)
         # same as 'date' if there is no invoice
     is_revenue = db.Column(db.Boolean())
     amount = db.Column(db.Numeric(11, 2))
@@ -256,10 +392,10 @@ class Transaction(db.Model):
     description = db.Column(db.Text)
     bank_id = db.Column(db.Integer, db.ForeignKey('accounting_banks.id'))
         # the bankaccount involved. cash transactions are considered an account too (id=99)
-    bank = db.relationship("Bank", backref="Transaction", lazy="joined")
+    bank = db.relationship("Bank", backref="Transaction")
     bank_statement_number = db.Column(db.Integer)
         # number in the bank's account statements
-    date_filed = db.Column(db.Date())
+    date_filed = db.Column(db.Date(), index=True)
         # if it is a reimbursement this is the date the request was approved
     filed_by_id = db.Column(db.Integer, db.ForeignKey('members.id'))
         # if it is a reimbursement this is the user that approved the request
@@ -267,16 +403,22 @@ class Transaction(db.Model):
     reimbursement_comments = db.Column(db.Text)
     attachments = db.relationship('AccountingAttachment', secondary=attachments_transactions,
         backref=db.backref('transactions', lazy='dynamic'))
+    __table_args__ = (
+        db.Index('ix_accounting_transactions_bank_id_facturation_date', 'bank_id', 'facturation_date'),
+            # the kasboek of a bank
+        db.Index('ix_accounting_transactions_date_bank_statement_number', 'date', 'bank_statement_number'),
+            # the transaction log is sorted on these
+    )
 
 
 class BarAccountLog(db.Model):
     """Define the bar_accounts database table"""
     __tablename__ = 'bar_accounts_log'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('members.id'))
-    user = db.relationship('User', backref="bar_account_log", lazy="joined")
-    purchase_id = db.Column(db.Integer, db.ForeignKey('bar_log.id'))
-    purchase = db.relationship('BarLog', backref="bar_account_transaction", lazy="joined")
+    user_id = db.Column(db.Integer, db.ForeignKey('members.id'), index=True)
+    user = db.relationship('User', backref="bar_account_log")
+    purchase_id = db.Column(db.Integer, db.ForeignKey('bar_log.id'), index=True)
+    purchase = db.relationship('BarLog', backref="bar_account_transaction")
     transaction_id = db.Column(db.Integer, db.ForeignKey('accounting_transactions.id'))
     transaction = db.relationship('Transaction')
 
@@ -287,3 +429,518 @@ class BarAccountLog(db.Model):
             return self.purchase.datetime
         else:
             return _date_to_datetime(self.transaction.date)
+
+
+class ClosedYear(db.Model):
+    """Define the accounting_closed_years database table"""
+    __tablename__ = 'accounting_closed_years'
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    closed_on = db.Column(db.DateTime())
+    closed_by_id = db.Column(db.Integer, db.ForeignKey('members.id'))
+        # empty if the year was closed from the command line
+    closed_by = db.relationship('User')
+
+
+class ClosedYearEntry(db.Model):
+    """Define the accounting_closed_entries database table"""
+    __tablename__ = 'accounting_closed_entries'
+    id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, db.ForeignKey('accounting_closed_years.year'), index=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('accounting_transactions.id'))
+    facturation_date = db.Column(db.Date())
+    description = db.Column(db.Text)
+    is_revenue = db.Column(db.Boolean())
+    amount = db.Column(db.Numeric(11, 2))
+    bank_id = db.Column(db.Integer)
+    bank = db.Column(db.String(256))
+        # the name of the bank when the year was closed
+    number = db.Column(db.Integer)
+        # the dagboek number of the transaction for its bank
+    running_total = db.Column(db.Numeric(11, 2))
+        # the kasboek total of the bank up to and including this transaction
+    legal_category = db.Column(db.String(256))
+
+
+class ClosedYearTotal(db.Model):
+    """Define the accounting_closed_totals database table"""
+    __tablename__ = 'accounting_closed_totals'
+    year = db.Column(db.Integer, db.ForeignKey('accounting_closed_years.year'), primary_key=True,
+                     autoincrement=False)
+    bank_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    revenue = db.Column(db.Numeric(11, 2))
+    expenses = db.Column(db.Numeric(11, 2))
+    balance = db.Column(db.Numeric(11, 2))
+
+
+class ClosedYearError(Exception):
+    """Raised when a flush would change a transaction of a closed year"""
+
+
+@event.listens_for(Session, 'before_flush')
+def protect_closed_years(session, flush_context, instances):
+    dates = set()
+    modified = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    for obj in list(session.new) + modified + list(session.deleted):
+        if isinstance(obj, Transaction):
+            # a transaction can neither be moved into nor out of a closed year
+            history = get_history(obj, 'facturation_date')
+            dates.update(history.sum())
+    years = set(date.year for date in dates if date)
+    if years:
+        closed = session.query(ClosedYear.year).filter(ClosedYear.year.in_(years)).all()
+        if closed:
+            raise ClosedYearError("The books of %s are closed" % ", ".join(str(row.year) for row in closed))
+
+
+@event.listens_for(Session, 'before_flush')
+def update_daily_rollup(session, flush_context, instances):
+    # bar_log rows are only added and deleted, never changed
+    changes = {}
+    for obj, sign in [(obj, 1) for obj in session.new] + [(obj, -1) for obj in session.deleted]:
+        if isinstance(obj, BarLog) and obj.datetime and obj.item_id:
+            key = (obj.datetime.date(), obj.item_id, obj.transaction_type)
+            amount, revenue = changes.get(key, (0, 0))
+            changes[key] = (amount + sign * obj.amount, revenue + sign * (obj.price or 0))
+    for (day, item_id, transaction_type), (amount, revenue) in sorted(changes.items()):
+        _add_to_daily_rollup(session, day, item_id, transaction_type, amount, revenue)
+
+
+def _add_to_daily_rollup(session, day, item_id, transaction_type, amount, revenue):
+    rollup = BarDailyRollup.__table__
+    values = {'day': day, 'item_id': item_id, 'transaction_type': transaction_type,
+              'amount': amount, 'revenue': revenue}
+    if db.engine.dialect.name == 'mysql':
+        # concurrent sales could both insert the first row of the day
+        session.execute(text('INSERT INTO bar_daily_rollup (day, item_id, transaction_type, amount, revenue) '
+                             'VALUES (:day, :item_id, :transaction_type, :amount, :revenue) '
+                             'ON DUPLICATE KEY UPDATE amount = amount + VALUES(amount), '
+                             'revenue = revenue + VALUES(revenue)'), values)
+        return
+    # SQLite serializes writes, so no other transaction can insert the row in between
+    updated = session.execute(rollup.update()
+                              .where(and_(rollup.c.day == day, rollup.c.item_id == item_id,
+                                          rollup.c.transaction_type == transaction_type))
+                              .values(amount=rollup.c.amount + amount, revenue=rollup.c.revenue + revenue)).rowcount
+    if not updated:
+        session.execute(rollup.insert().values(**values))
+
+
+# Relationships are loaded lazily by default. Every list view loads what its
+# template uses with one of these profiles, e.g.
+# BarLog.query.options(*LOAD_PROFILES['bar log'])
+LOAD_PROFILES = {
+    'stock list': [joinedload(StockItem.category)],
+    'bar log': [joinedload(BarLog.item).load_only('name'),
+                joinedload(BarLog.user).load_only('name')],
+    'cash log': [joinedload(CashTransaction.purchase).joinedload(BarLog.item).load_only('name')],
+    'bar account log': [joinedload(BarAccountLog.purchase).joinedload(BarLog.item).load_only('name'),
+                        joinedload(BarAccountLog.transaction).load_only('date', 'amount')],
+    'accounting log': [joinedload(Transaction.bank),
+                       joinedload(Transaction.category),
+                       joinedload(Transaction.filed_by).load_only('name'),
+                       subqueryload(Transaction.attachments)],
+    'reimbursement requests': [subqueryload(Transaction.attachments)],
+    'membership fees': [joinedload(MembershipFee.user).load_only('name'),
+                        joinedload(MembershipFee.transaction).load_only('date', 'amount')],
+    'members list': [subqueryload(User.roles)],
+    'api': [joinedload(StockItem.category)],
+}
+
+
+def bar_account_balances(minimum=None):
+    """Return a query for (user_id, name, balance) of all users, ordered by name.
+
+    The balances are calculated from the bar account log in a single aggregate
+    query. If minimum is given, only users with a balance larger than minimum
+    are returned. minimum can be a value or a scalar SQL expression.
+    """
+    change = case([(BarAccountLog.purchase_id != None, -BarLog.price)],
+                  else_=Transaction.amount)
+    balance = func.coalesce(func.sum(change), 0).label('balance')
+    query = db.session.query(User.id.label('user_id'), User.name, balance) \
+        .outerjoin(BarAccountLog, BarAccountLog.user_id == User.id) \
+        .outerjoin(BarLog, BarLog.id == BarAccountLog.purchase_id) \
+        .outerjoin(Transaction, Transaction.id == BarAccountLog.transaction_id) \
+        .group_by(User.id, User.name) \
+        .order_by(User.name)
+    if minimum is not None:
+        query = query.having(balance > minimum)
+    return query
+
+
+def membership_paid_until():
+    """Return a subquery for (user_id, until), the latest until of the membership fees of every user"""
+    return db.session.query(MembershipFee.user_id, func.max(MembershipFee.until).label('until')) \
+        .group_by(MembershipFee.user_id).subquery()
+
+
+def overdue_members(today=None):
+    """Return a query for the active members whose membership dues are paid until before today
+    (or who never paid), the longest overdue first"""
+    today = today or datetime.date.today()
+    return User.query.filter(User.active_member,
+                             or_(User.membership_paid_until == None, User.membership_paid_until < today)) \
+        .order_by(User.membership_paid_until, User.name)
+
+
+def accounting_summary(year):
+    """Return the figures of the accounting dashboard as a dict.
+
+    'banks' is a list of (name, balance) tuples, 'running_account' the
+    balance of the cash register and 'months' a list of (month, revenue,
+    expenses) tuples for every month of year. The bank balances and the
+    monthly figures come from a single aggregate query grouped by bank and
+    month.
+    """
+    transaction_year = extract('year', Transaction.date).label('year')
+    transaction_month = extract('month', Transaction.date).label('month')
+    revenue = func.coalesce(func.sum(case([(Transaction.is_revenue == True, Transaction.amount)], else_=0)), 0,
+                            type_=Transaction.amount.type)
+    expenses = func.coalesce(func.sum(case([(Transaction.is_revenue == True, 0)], else_=Transaction.amount)), 0,
+                             type_=Transaction.amount.type)
+    rows = db.session.query(Bank.id, Bank.name, transaction_year, transaction_month,
+                            revenue.label('revenue'), expenses.label('expenses')) \
+        .outerjoin(Transaction, Transaction.bank_id == Bank.id) \
+        .group_by(Bank.id, Bank.name, transaction_year, transaction_month) \
+        .order_by(Bank.id)
+    balances = []
+    months = dict((month, [0, 0]) for month in range(1, 13))
+    for row in rows:
+        if not balances or balances[-1][0] != row.id:
+            balances.append([row.id, row.name, 0])
+        balances[-1][2] += row.revenue - row.expenses
+        if row.year == year:
+            months[row.month][0] += row.revenue
+            months[row.month][1] += row.expenses
+    running_account = db.session.query(
+        func.coalesce(func.sum(CashTransaction.amount), 0, type_=CashTransaction.amount.type)).scalar()
+    return {'banks': [(name, balance) for id, name, balance in balances],
+            'running_account': running_account,
+            'months': [(month, revenue, expenses) for month, (revenue, expenses) in sorted(months.items())]}
+
+
+def stock_levels(item_ids=None, until_log_id=None):
+    """Return a dict mapping stock item ids to their current stock level.
+
+    The stock level of an item is its latest StockSnapshot plus the bar_log rows
+    added since, calculated for all items (or only item_ids) in a single query.
+    If until_log_id is given, bar_log rows with a higher id are ignored.
+    """
+    if item_ids is not None and not item_ids:
+        return {}
+    return dict((item_id, int(amount)) for item_id, amount in stock_levels_query(item_ids, until_log_id))
+
+
+def stock_levels_query(item_ids=None, until_log_id=None):
+    """Return the query of stock_levels(), for (item_id, stock level) rows"""
+    # correlated, so only the snapshots of the requested items are read
+    latest_id = db.session.query(func.max(StockSnapshot.id)) \
+        .filter(StockSnapshot.item_id == StockItem.id).correlate(StockItem).as_scalar()
+    snapshot_condition = and_(StockSnapshot.item_id == StockItem.id, StockSnapshot.id == latest_id)
+    log_condition = and_(BarLog.item_id == StockItem.id,
+                         BarLog.id > func.coalesce(StockSnapshot.last_log_id, 0))
+    if until_log_id is not None:
+        log_condition = and_(log_condition, BarLog.id <= until_log_id)
+    stock = func.coalesce(StockSnapshot.amount, 0) + func.coalesce(func.sum(BarLog.amount), 0)
+    query = db.session.query(StockItem.id, stock) \
+        .outerjoin(StockSnapshot, snapshot_condition) \
+        .outerjoin(BarLog, log_condition) \
+        .group_by(StockItem.id, StockSnapshot.amount)
+    if item_ids is not None:
+        query = query.filter(StockItem.id.in_(item_ids))
+    return query
+
+
+def take_stock_snapshot():
+    """Add a StockSnapshot with the current stock level of every stock item to the session.
+
+    The snapshots they replace are deleted, so there is one per stock item.
+    Returns the number of snapshots added, the caller is responsible for committing.
+    """
+    last_log_id = db.session.query(func.max(BarLog.id)).scalar() or 0
+    now = datetime.datetime.now()
+    levels = stock_levels(until_log_id=last_log_id)
+    StockSnapshot.query.delete(synchronize_session=False)
+    for item_id, amount in levels.items():
+        db.session.add(StockSnapshot(item_id=item_id, amount=amount,
+                                     last_log_id=last_log_id, datetime=now))
+    return len(levels)
+
+
+def stocktake(counts, user_id=None):
+    """Add a correction to the bar log for every stock item whose counted amount differs from its stock level.
+
+    counts maps stock item ids to the counted amounts, the stock levels of all
+    of them are read in a single query. Returns a list of (item_id, expected,
+    counted) tuples of the corrected items, the caller is responsible for
+    committing.
+    """
+    levels = stock_levels(counts.keys())
+    now = datetime.datetime.now()
+    variances = []
+    for item_id, counted in sorted(counts.items()):
+        expected = levels.get(item_id, 0)
+        if counted != expected:
+            db.session.add(BarLog(item_id=item_id, amount=counted - expected, user_id=user_id,
+                                  transaction_type="correction", datetime=now))
+            variances.append((item_id, expected, counted))
+    return variances
+
+
+def rebuild_daily_rollup():
+    """Recalculate bar_daily_rollup from the whole bar log, returns the number of rows.
+    The caller is responsible for committing."""
+    BarDailyRollup.query.delete()
+    day = func.date(BarLog.datetime)
+    totals = db.session.query(day, BarLog.item_id, BarLog.transaction_type,
+                              func.sum(BarLog.amount), func.coalesce(func.sum(BarLog.price), 0)) \
+        .filter(BarLog.datetime != None, BarLog.item_id != None) \
+        .group_by(day, BarLog.item_id, BarLog.transaction_type)
+    rollup = BarDailyRollup.__table__
+    db.session.execute(rollup.insert().from_select(
+        ['day', 'item_id', 'transaction_type', 'amount', 'revenue'], totals.selectable))
+    return BarDailyRollup.query.count()
+
+
+def sales_per_item(start, end):
+    """Return a query for (item_id, name, sold, revenue) of the stock items sold from start until end
+    (excluding end), best selling first. It only reads bar_daily_rollup."""
+    sold = (-func.sum(BarDailyRollup.amount)).label('sold')
+    return db.session.query(StockItem.id.label('item_id'), StockItem.name, sold,
+                            func.sum(BarDailyRollup.revenue).label('revenue')) \
+        .join(BarDailyRollup, BarDailyRollup.item_id == StockItem.id) \
+        .filter(BarDailyRollup.transaction_type == 'sale',
+                BarDailyRollup.day >= start, BarDailyRollup.day < end) \
+        .group_by(StockItem.id, StockItem.name) \
+        .order_by(sold.desc(), StockItem.name)
+
+
+def sales_per_day(start, end):
+    """Return a query for (day, sold, revenue) of the days from start until end (excluding end)
+    with sales, from bar_daily_rollup"""
+    return db.session.query(BarDailyRollup.day, (-func.sum(BarDailyRollup.amount)).label('sold'),
+                            func.sum(BarDailyRollup.revenue).label('revenue')) \
+        .filter(BarDailyRollup.transaction_type == 'sale',
+                BarDailyRollup.day >= start, BarDailyRollup.day < end) \
+        .group_by(BarDailyRollup.day) \
+        .order_by(BarDailyRollup.day)
+
+
+def bump_version(name):
+    """Increase the version called name, in the current DB transaction.
+    Call this whenever the data cached under that name changes.
+    """
+    now = datetime.datetime.utcnow()
+    updated = Version.query.filter_by(name=name) \
+        .update({Version.version: Version.version + 1, Version.modified: now},
+                synchronize_session=False)
+    if not updated:
+        db.session.add(Version(name=name, version=1, modified=now))
+    record_change(name)
+
+
+def get_versions(*names):
+    """Return a dict mapping each name to a (version, modified) tuple, using a single query"""
+    versions = dict((name, (0, None)) for name in names)
+    for version in Version.query.filter(Version.name.in_(names)):
+        versions[version.name] = (version.version, version.modified)
+    return versions
+
+
+def window_functions_supported():
+    """Return whether the database supports window functions such as SUM() OVER"""
+    dialect = db.engine.dialect
+    if dialect.name == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 25)
+    if dialect.name == 'mysql':
+        version = dialect.server_version_info or ()
+        if 'MariaDB' in version:
+            return version >= (10, 2)
+        return version >= (8, 0)
+    return True
+
+
+def transaction_years():
+    """Return the distinct years with facturated transactions, newest first"""
+    year = extract('year', Transaction.facturation_date).label('year')
+    query = db.session.query(year).filter(Transaction.facturation_date != None) \
+        .distinct().order_by(year.desc())
+    return [row.year for row in query]
+
+
+def kasboek(bank_id, start, end):
+    """Return (entries, totals) for the transactions of a bank facturated from start until end.
+
+    entries is an iterator over the transactions ordered by facturation date,
+    which have an id, facturation_date, description, is_revenue, amount and
+    running_total. It reads the rows in batches, so exports of any size can
+    be streamed. totals has the revenue, expenses and balance of the whole
+    period. Both are calculated by the database, the running total with a
+    window function where it is supported.
+    """
+    period = and_(Transaction.bank_id == bank_id,
+                  Transaction.facturation_date >= start,
+                  Transaction.facturation_date < end)
+    signed_amount = case([(Transaction.is_revenue == True, Transaction.amount)], else_=-Transaction.amount)
+
+    revenue = func.sum(case([(Transaction.is_revenue == True, Transaction.amount)], else_=0))
+    expenses = func.sum(case([(Transaction.is_revenue == True, 0)], else_=Transaction.amount))
+    amount_type = Transaction.amount.type
+    totals = db.session.query(func.coalesce(revenue, 0, type_=amount_type).label('revenue'),
+                              func.coalesce(expenses, 0, type_=amount_type).label('expenses'),
+                              func.coalesce(func.sum(signed_amount), 0, type_=amount_type).label('balance')) \
+        .filter(period).one()
+
+    columns = [Transaction.id, Transaction.facturation_date, Transaction.description,
+               Transaction.is_revenue, Transaction.amount]
+    order_by = [Transaction.facturation_date, Transaction.id]
+    if window_functions_supported():
+        running_total = func.sum(signed_amount).over(order_by=order_by).label('running_total')
+        entries = db.session.query(*(columns + [running_total])).filter(period).order_by(*order_by) \
+            .yield_per(1000)
+    else:
+        query = db.session.query(*columns).filter(period).order_by(*order_by).yield_per(1000)
+        entries = _running_totals(query)
+    return iter(entries), totals
+
+
+def _running_totals(query):
+    running_total = 0
+    for row in query:
+        running_total += row.amount if row.is_revenue else -row.amount
+        yield KeyedTuple(list(row) + [running_total], row.keys() + ['running_total'])
+
+
+def dagboek(start, end, is_revenue):
+    """Return (entries, banks, categories) for the dagboek of the transactions facturated from start until end.
+
+    Every transaction of a bank is numbered in order of facturation date,
+    revenues and expenses alike, in a single ordered pass. entries is an
+    iterator over the entries of the requested type, dicts with the number
+    and amount under 'number_<bank>' and 'bank_<bank>' and the amount under
+    'category_<legal category>'. banks are the names of the banks used in the
+    period, categories the sorted legal categories of the entries.
+    """
+    period = and_(Transaction.facturation_date >= start, Transaction.facturation_date < end)
+    banks = set(row.name for row in db.session.query(Bank.name).join(Transaction, Transaction.bank_id == Bank.id)
+                .filter(period).distinct())
+    categories = sorted(row.legal_category for row in db.session.query(AccountingCategory.legal_category)
+                        .join(Transaction, Transaction.category_id == AccountingCategory.id)
+                        .filter(period, _is_type(is_revenue)).distinct())
+    query = db.session.query(Transaction.id, Transaction.facturation_date, Transaction.description,
+                             Transaction.amount, Transaction.is_revenue,
+                             Bank.name.label('bank'), AccountingCategory.legal_category) \
+        .outerjoin(Bank, Bank.id == Transaction.bank_id) \
+        .outerjoin(AccountingCategory, AccountingCategory.id == Transaction.category_id) \
+        .filter(period) \
+        .order_by(Transaction.facturation_date, Transaction.id) \
+        .yield_per(1000)
+    return _number_dagboek(query, is_revenue), banks, categories
+
+
+def _is_type(is_revenue):
+    # transactions without a type count as expenses
+    if is_revenue:
+        return Transaction.is_revenue == True
+    return or_(Transaction.is_revenue == False, Transaction.is_revenue == None)
+
+
+def _number_dagboek(query, is_revenue):
+    numbers = {}
+    for row in query:
+        entry = {'id': row.id, 'facturation_date': row.facturation_date,
+                 'description': row.description, 'amount': row.amount}
+        if row.bank is not None:
+            numbers[row.bank] = numbers.get(row.bank, 0) + 1
+            entry['number_' + row.bank] = numbers[row.bank]
+            entry['bank_' + row.bank] = row.amount
+        if row.legal_category is not None:
+            entry['category_' + row.legal_category] = row.amount
+        if bool(row.is_revenue) == is_revenue:
+            yield entry
+
+
+def is_closed(year):
+    """Return whether the books of year are closed"""
+    return ClosedYear.query.get(year) is not None
+
+
+def close_year(year, user_id=None):
+    """Freeze the kasboek and dagboek of year into the closed year tables, in the current DB transaction.
+
+    After the commit the transactions facturated in year can no longer be
+    changed, and closed_kasboek() and closed_dagboek() serve the reports.
+    """
+    db.session.add(ClosedYear(year=year, closed_on=datetime.datetime.now(), closed_by_id=user_id))
+    query = db.session.query(Transaction.id, Transaction.facturation_date, Transaction.description,
+                             Transaction.amount, Transaction.is_revenue, Transaction.bank_id,
+                             Bank.name.label('bank'), AccountingCategory.legal_category) \
+        .outerjoin(Bank, Bank.id == Transaction.bank_id) \
+        .outerjoin(AccountingCategory, AccountingCategory.id == Transaction.category_id) \
+        .filter(Transaction.facturation_date >= datetime.date(year, 1, 1),
+                Transaction.facturation_date < datetime.date(year + 1, 1, 1)) \
+        .order_by(Transaction.facturation_date, Transaction.id)
+    # the same order as kasboek() and dagboek(), so the numbers and running totals match
+    totals = {}
+    entries = []
+    for row in query:
+        number = running_total = None
+        if row.bank is not None:
+            total = totals.setdefault(row.bank_id, {'count': 0, 'revenue': 0, 'expenses': 0})
+            total['count'] += 1
+            total['revenue' if row.is_revenue else 'expenses'] += row.amount
+            number = total['count']
+            running_total = total['revenue'] - total['expenses']
+        entries.append({'year': year, 'transaction_id': row.id, 'facturation_date': row.facturation_date,
+                        'description': row.description, 'is_revenue': bool(row.is_revenue),
+                        'amount': row.amount, 'bank_id': row.bank_id, 'bank': row.bank,
+                        'number': number, 'running_total': running_total,
+                        'legal_category': row.legal_category})
+    db.session.flush()
+    if entries:
+        db.session.execute(ClosedYearEntry.__table__.insert(), entries)
+    for bank_id, total in totals.items():
+        db.session.add(ClosedYearTotal(year=year, bank_id=bank_id, revenue=total['revenue'],
+                                       expenses=total['expenses'],
+                                       balance=total['revenue'] - total['expenses']))
+    return len(entries)
+
+
+def closed_kasboek(year, bank_id):
+    """Return the kasboek of a closed year, in the same form as kasboek()"""
+    entries = db.session.query(ClosedYearEntry.transaction_id.label('id'), ClosedYearEntry.facturation_date,
+                               ClosedYearEntry.description, ClosedYearEntry.is_revenue,
+                               ClosedYearEntry.amount, ClosedYearEntry.running_total) \
+        .filter_by(year=year, bank_id=bank_id) \
+        .order_by(ClosedYearEntry.facturation_date, ClosedYearEntry.transaction_id) \
+        .yield_per(1000)
+    totals = ClosedYearTotal.query.get((year, bank_id))
+    return iter(entries), totals
+
+
+def closed_dagboek(year, is_revenue):
+    """Return the dagboek of a closed year, in the same form as dagboek()"""
+    banks = set(row.bank for row in db.session.query(ClosedYearEntry.bank)
+                .filter(ClosedYearEntry.year == year, ClosedYearEntry.bank != None).distinct())
+    categories = sorted(row.legal_category for row in db.session.query(ClosedYearEntry.legal_category)
+                        .filter(ClosedYearEntry.year == year, ClosedYearEntry.is_revenue == is_revenue,
+                                ClosedYearEntry.legal_category != None).distinct())
+    query = db.session.query(ClosedYearEntry.transaction_id, ClosedYearEntry.facturation_date,
+                             ClosedYearEntry.description, ClosedYearEntry.amount, ClosedYearEntry.bank,
+                             ClosedYearEntry.number, ClosedYearEntry.legal_category) \
+        .filter_by(year=year, is_revenue=is_revenue) \
+        .order_by(ClosedYearEntry.facturation_date, ClosedYearEntry.transaction_id) \
+        .yield_per(1000)
+    return _closed_dagboek_entries(query), banks, categories
+
+
+def _closed_dagboek_entries(query):
+    for row in query:
+        entry = {'id': row.transaction_id, 'facturation_date': row.facturation_date,
+                 'description': row.description, 'amount': row.amount}
+        if row.bank is not None:
+            entry['number_' + row.bank] = row.number
+            entry['bank_' + row.bank] = row.amount
+        if row.legal_category is not None:
+            entry['category_' + row.legal_category] = row.amount
+        yield entry
@@ -0,0 +1,118 @@
+"""Publish change events to the bar terminals
+
+Changes are recorded on the DB session by database.bump_version() and
+User.add_to_bar_account(). When the session is committed they are published
+to a broker, from which /api/events streams them to the terminals.
+The broker is shared by all worker processes, set EVENT_BROKER to the import
+path of another Broker subclass to swap it out.
+"""
+
+from MALMan import app
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.utils import import_string
+
+import json
+import sqlite3
+import time
+
+
+class Broker(object):
+    """The interface every broker has to implement"""
+
+    def publish(self, topic, data):
+        """Store an event and return its id, ids have to increase monotonically"""
+        raise NotImplementedError
+
+    def publish_many(self, events):
+        """Store the (topic, data) events in this order and return their ids.
+        Brokers that can store several events at once should override this."""
+        return [self.publish(topic, data) for topic, data in events]
+
+    def since(self, event_id):
+        """Return the events newer than event_id as (id, topic, data) tuples, oldest first"""
+        raise NotImplementedError
+
+    def last_id(self):
+        """Return the id of the newest event, 0 if there are none"""
+        raise NotImplementedError
+
+
+class SQLiteBroker(Broker):
+    """Keep the events in a local SQLite file, which all worker processes can access"""
+
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        connection = self._connect()
+        connection.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'topic TEXT, data TEXT, created REAL)')
+        connection.commit()
+        connection.close()
+
+    def _connect(self):
+        # a connection can't be shared between threads, so every call opens one
+        return sqlite3.connect(self.path, timeout=10)
+
+    def publish(self, topic, data):
+        return self.publish_many([(topic, data)])[0]
+
+    def publish_many(self, events):
+        # all events of a commit are stored in one transaction
+        connection = self._connect()
+        now = time.time()
+        ids = [connection.execute('INSERT INTO events (topic, data, created) VALUES (?, ?, ?)',
+                                  (topic, json.dumps(data), now)).lastrowid
+               for topic, data in events]
+        connection.execute('DELETE FROM events WHERE created < ?', (now - self.retention,))
+        connection.commit()
+        connection.close()
+        return ids
+
+    def since(self, event_id):
+        connection = self._connect()
+        rows = connection.execute('SELECT id, topic, data FROM events WHERE id > ? ORDER BY id',
+                                  (event_id,)).fetchall()
+        connection.close()
+        return [(id, topic, json.loads(data)) for id, topic, data in rows]
+
+    def last_id(self):
+        connection = self._connect()
+        last_id = connection.execute('SELECT MAX(id) FROM events').fetchone()[0]
+        connection.close()
+        return last_id or 0
+
+
+_broker = None
+
+
+def get_broker():
+    """Return the broker configured by EVENT_BROKER"""
+    global _broker
+    if _broker is None:
+        broker_class = import_string(app.config['EVENT_BROKER'])
+        _broker = broker_class(app.config['EVENT_BROKER_PATH'], app.config['EVENT_RETENTION'])
+    return _broker
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_changes(session):
+    changes = session.info.pop('changes', [])
+    # the same change is often recorded more than once in a transaction
+    unique_changes = []
+    for change in changes:
+        if change not in unique_changes:
+            unique_changes.append(change)
+    if not unique_changes:
+        return
+    try:
+        get_broker().publish_many(unique_changes)
+    except Exception:
+        # the changes are committed, terminals not hearing of them is no reason to fail
+        app.logger.exception('Could not publish the change events %r' % (unique_changes,))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('changes', None)
@@ -11,6 +11,9 @@ from flask.ext.uploads import UploadSet, configure_uploads
 
 from flask_security.forms import ConfirmRegisterForm, unique_user_email
 
+from collections import OrderedDict
+import threading
+
 attachments = UploadSet(name='attachments')
 configure_uploads(app, attachments)
 
@@ -31,7 +34,7 @@ def check_unique_stock_name(form, field):
         raise ValidationError('There is already a stockitem with this name')
 
 class NewMembers(Form):
-    #some fields are added by the view
+    # the view adds a field per new member, see form_class()
     submit = SubmitField("activate account(s)")
 
 
@@ -65,7 +68,7 @@ class MembersEditOwnAccount(Form):
 
 
 class MembersEditAccount(MembersEditOwnAccount):
-    # some fields are added by the view
+    # the view adds a field per role, see form_class()
     membership_dues = DecimalField('Monthly dues (&euro;)', [
         validators.NumberRange(min=0,
             message='please enter a positive number')])
@@ -115,13 +118,12 @@ class BarRemoveItem(Form):
 
 
 class BarActivateItem(Form):
-    #some fields are added by the view
+    # the view adds a field per stock item, see stock_item_form_class()
     submit = SubmitField("activate stock item(s)")
 
 
-# this is not used, check views.py for more info
 class BarEditAmounts(Form):
-    # some fields are added by the view
+    # the view adds a field per stock item, see stock_item_form_class()
     submit = SubmitField('ok!')
 
 
@@ -139,7 +141,7 @@ class BarEditItem(Form):
 
 
 class BarEdit(Form):
-    # the view adds a BarEditItem form for each stock item
+    # the view adds a BarEditItem form for each stock item, see stock_item_form_class()
     submit = SubmitField('edit stock items')
 
 
@@ -253,3 +255,43 @@ class FilterDagboek(Form):
     is_revenue = SelectField('type',
         choices = [("revenues", "revenues"), ("expenses", "expenses")])
     submit = SubmitField('go')
+
+
+class CloseYear(Form):
+    year = SelectField('year', coerce=int)
+    submit = SubmitField('close year')
+
+
+# the number of form classes with fields added by a view that are kept, see form_class()
+FORM_CLASS_CACHE_SIZE = 64
+_form_classes = OrderedDict()
+_form_classes_lock = threading.Lock()
+
+
+def form_class(base, key, fields):
+    """Return a subclass of base with the fields returned by fields(), a list of (name, field) tuples.
+
+    Views use this instead of adding fields to the form classes above, which
+    would keep them for every later request. The subclasses are cached on base
+    and key, so key has to identify everything the fields depend on. The least
+    recently used subclasses are dropped from the cache.
+    Values that change more often than the fields, such as the current stock,
+    should be passed to the form as data instead of as field defaults.
+    """
+    cache_key = (base, key)
+    with _form_classes_lock:
+        cls = _form_classes.pop(cache_key, None)
+        if cls is None:
+            cls = type(base.__name__, (base,), dict(fields()))
+        _form_classes[cache_key] = cls
+        while len(_form_classes) > FORM_CLASS_CACHE_SIZE:
+            _form_classes.popitem(last=False)
+    return cls
+
+
+def stock_item_form_class(base, items, field):
+    """Return form_class(base) with the (name, field) returned by field(item) for every stock item.
+    The fields are rebuilt when the items or the catalogue version change."""
+    catalogue = DB.get_versions('catalogue')['catalogue'][0]
+    key = (catalogue, tuple(item.id for item in items))
+    return form_class(base, key, lambda: [field(item) for item in items])
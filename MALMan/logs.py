@@ -1,4 +1,10 @@
-"""Keep a log and send out email in case an error happens"""
+"""Keep a log and send out email in case an error happens
+
+If INSTRUMENTATION is set, also log the number of queries, database time,
+template render time and wall time of every request, and log slow requests
+with their SQL statements (and statements repeated suspiciously often) to a
+separate slow request log.
+"""
 
 from MALMan import app
 
@@ -9,3 +15,83 @@ if not app.debug:
     file_handler = RotatingFileHandler(app.config['LOGPATH'], maxBytes=1024*1024, backupCount=5)
     file_handler.setLevel(logging.WARNING)
     app.logger.addHandler(file_handler)
+
+
+if app.config['INSTRUMENTATION']:
+    import logging
+    import re
+    import time
+    from logging.handlers import RotatingFileHandler
+    from flask import g, request, has_request_context
+    from jinja2 import Template
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    request_log = logging.getLogger('MALMan.requests')
+    request_log.setLevel(logging.INFO)
+    request_log.addHandler(RotatingFileHandler(app.config['REQUEST_LOGPATH'], maxBytes=1024*1024, backupCount=5))
+    # the app logger mails errors, these only go to their own files
+    request_log.propagate = False
+    slow_log = logging.getLogger('MALMan.slow_requests')
+    slow_log.setLevel(logging.INFO)
+    slow_log.addHandler(RotatingFileHandler(app.config['SLOW_REQUEST_LOGPATH'], maxBytes=1024*1024, backupCount=5))
+    slow_log.propagate = False
+
+    # collapses the parameter lists of IN clauses, so they don't make statements look different
+    parameter_list = re.compile(r'\((?:\?|%s)(?:, (?:\?|%s))*\)')
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.time())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        duration = time.time() - conn.info['query_started'].pop()
+        if has_request_context() and hasattr(g, 'queries'):
+            g.queries.append((statement, duration))
+
+    class TimedTemplate(Template):
+        """A template that adds its render time to the request's template time.
+        This includes the queries the template triggers (e.g. lazy loaded relationships)."""
+
+        def render(self, *args, **kwargs):
+            started = time.time()
+            try:
+                return super(TimedTemplate, self).render(*args, **kwargs)
+            finally:
+                if has_request_context() and hasattr(g, 'template_time'):
+                    g.template_time += time.time() - started
+
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.time()
+        g.queries = []
+        g.template_time = 0
+
+    @app.after_request
+    def log_request(response):
+        if not hasattr(g, 'request_started'):
+            return response
+        wall_time = (time.time() - g.request_started) * 1000
+        db_time = sum(duration for statement, duration in g.queries) * 1000
+        summary = '%s %s %s: %.1fms, %i queries in %.1fms, templates %.1fms' % (
+            request.method, request.full_path, response.status_code, wall_time,
+            len(g.queries), db_time, g.template_time * 1000)
+        request_log.info(summary)
+
+        shapes = {}
+        for statement, duration in g.queries:
+            shape = parameter_list.sub('(?)', statement)
+            shapes[shape] = shapes.get(shape, 0) + 1
+        for shape, count in shapes.items():
+            if count > app.config['N_PLUS_ONE_THRESHOLD']:
+                slow_log.warning('possible N+1 query in %s %s, executed %i times: %s',
+                                 request.method, request.full_path, count, shape)
+
+        if wall_time > app.config['SLOW_REQUEST_THRESHOLD']:
+            statements = '\n'.join('  %.1fms %s' % (duration * 1000, ' '.join(statement.split()))
+                                   for statement, duration in g.queries)
+            slow_log.info('slow request %s\n%s', summary, statements)
+        return response
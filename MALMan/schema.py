@@ -0,0 +1,190 @@
+"""Migrate the database schema and check the index plan of the hot queries
+
+db.create_all() only creates missing tables, so columns and indexes added to
+existing tables need a migration. Every migration checks what is already
+there, so they also run safely on a database made by create_all(). The
+applied versions are stored in the schema_migrations table.
+This is used by the migrate and explain_hot_queries commands in commands.py.
+"""
+
+from MALMan import app
+import MALMan.database as DB
+
+from sqlalchemy import inspect, bindparam
+from sqlalchemy.schema import Index
+
+import datetime
+
+MIGRATIONS = []
+
+
+def migration(version):
+    """Register the decorated function as the migration to version"""
+    def register(function):
+        MIGRATIONS.append((version, function))
+        MIGRATIONS.sort()
+        return function
+    return register
+
+
+def _column_names(table_name):
+    return [column['name'] for column in inspect(DB.db.engine).get_columns(table_name)]
+
+
+def _add_column(table_name, column):
+    if column.name not in _column_names(table_name):
+        column_type = column.type.compile(dialect=DB.db.engine.dialect)
+        DB.db.session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table_name, column.name, column_type))
+        return True
+    return False
+
+
+def _create_index(index):
+    existing = [existing['name'] for existing in inspect(DB.db.engine).get_indexes(index.table.name)]
+    if index.name not in existing:
+        index.create(DB.db.session.connection())
+
+
+def _model_index(model, name):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+@migration(1)
+def add_stored_balances_and_sync_tables():
+    """Add the stored bar account balances, idempotent sales and the snapshot, version and sync tables"""
+    for model in [DB.StockSnapshot, DB.Version, DB.SyncChange,
+                  DB.ClosedYear, DB.ClosedYearEntry, DB.ClosedYearTotal]:
+        model.__table__.create(DB.db.session.connection(), checkfirst=True)
+
+    if _add_column('members', DB.User.__table__.c.bar_account_balance):
+        balances = [{'user': row.user_id, 'balance': row.balance} for row in DB.bar_account_balances()]
+        if balances:
+            members = DB.User.__table__
+            DB.db.session.execute(members.update().where(members.c.id == bindparam('user'))
+                                  .values(bar_account_balance=bindparam('balance')), balances)
+
+    if _add_column('bar_log', DB.BarLog.__table__.c.idempotency_key):
+        # create_all() makes this a unique constraint of the column, which can't be added to an existing table
+        _create_index(Index('uq_bar_log_idempotency_key', DB.BarLog.__table__.c.idempotency_key, unique=True))
+
+
+@migration(2)
+def add_hot_query_indexes():
+    """Add the indexes used by the hot queries"""
+    for model, name in [(DB.User, 'ix_members_membership_start'),
+                        (DB.BarLog, 'ix_bar_log_item_id_id'),
+                        (DB.BarLog, 'ix_bar_log_datetime_id'),
+                        (DB.StockSnapshot, 'ix_bar_stock_snapshots_item_id_id'),
+                        (DB.BarAccountLog, 'ix_bar_accounts_log_user_id'),
+                        (DB.BarAccountLog, 'ix_bar_accounts_log_purchase_id'),
+                        (DB.CashTransaction, 'ix_accounting_cashregister_purchase_id'),
+                        (DB.Transaction, 'ix_accounting_transactions_facturation_date'),
+                        (DB.Transaction, 'ix_accounting_transactions_date_filed'),
+                        (DB.Transaction, 'ix_accounting_transactions_bank_id_facturation_date'),
+                        (DB.Transaction, 'ix_accounting_transactions_date_bank_statement_number')]:
+        _create_index(_model_index(model, name))
+
+
+@migration(3)
+def add_membership_paid_until():
+    """Store the latest until of the membership fees of every member"""
+    if _add_column('members', DB.User.__table__.c.membership_paid_until):
+        latest = DB.membership_paid_until()
+        paid_until = [{'user': row.user_id, 'until': row.until} for row in DB.db.session.query(latest)]
+        if paid_until:
+            members = DB.User.__table__
+            DB.db.session.execute(members.update().where(members.c.id == bindparam('user'))
+                                  .values(membership_paid_until=bindparam('until')), paid_until)
+
+
+@migration(4)
+def add_daily_rollup():
+    """Add the daily sales rollup, calculated from the bar log"""
+    if DB.BarDailyRollup.__tablename__ not in inspect(DB.db.engine).get_table_names():
+        DB.BarDailyRollup.__table__.create(DB.db.session.connection())
+        DB.rebuild_daily_rollup()
+
+
+def pending_migrations():
+    """Return the (version, function) of the migrations that weren't applied yet"""
+    DB.SchemaMigration.__table__.create(DB.db.engine, checkfirst=True)
+    applied = set(row.version for row in DB.db.session.query(DB.SchemaMigration.version))
+    return [(version, function) for version, function in MIGRATIONS if version not in applied]
+
+
+def migrate():
+    """Apply the migrations that weren't applied yet and return their descriptions"""
+    descriptions = []
+    for version, function in pending_migrations():
+        function()
+        description = function.__doc__
+        DB.db.session.add(DB.SchemaMigration(version=version, description=description,
+                                             applied=datetime.datetime.now()))
+        DB.db.session.commit()
+        descriptions.append("%i: %s" % (version, description))
+    return descriptions
+
+
+# (name, function returning the query) of the queries run on every page view or sale,
+# they have to be served by an index
+HOT_QUERIES = [
+    ('stock levels', lambda: DB.stock_levels_query([1])),
+    ('stock log page', lambda: DB.BarLog.query
+        .order_by(DB.BarLog.datetime.desc(), DB.BarLog.id.desc()).limit(app.config['ITEMS_PER_PAGE'])),
+    ('transaction log page', lambda: DB.Transaction.query.filter(DB.Transaction.date_filed != None)
+        .order_by(DB.Transaction.date.desc(), DB.Transaction.bank_statement_number.desc(),
+                  DB.Transaction.id.desc()).limit(app.config['ITEMS_PER_PAGE'])),
+    ('reimbursement requests', lambda: DB.Transaction.query.filter(DB.Transaction.date_filed == None)),
+    ('kasboek', lambda: DB.Transaction.query.filter(
+        DB.Transaction.bank_id == 1,
+        DB.Transaction.facturation_date >= datetime.date(2000, 1, 1),
+        DB.Transaction.facturation_date < datetime.date(2001, 1, 1))
+        .order_by(DB.Transaction.facturation_date, DB.Transaction.id)),
+    ('dagboek', lambda: DB.Transaction.query.filter(
+        DB.Transaction.facturation_date >= datetime.date(2000, 1, 1),
+        DB.Transaction.facturation_date < datetime.date(2001, 1, 1))),
+    ('new members', lambda: DB.User.query.filter_by(membership_start=None)),
+    ('sync changes', lambda: DB.SyncChange.query.filter(DB.SyncChange.id > 1)),
+]
+
+
+def explain(query):
+    """Return the query plan of query as a list of (table, full scan, detail) tuples.
+    Reading a whole table or index is a full scan, unless the query has a LIMIT
+    and reads an index in its ORDER BY order, so it stops after LIMIT rows."""
+    dialect = DB.db.engine.dialect
+    limited = query.statement._limit is not None
+    compiled = query.with_labels().statement.compile(dialect=dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    if dialect.name == 'sqlite':
+        plan = []
+        for row in DB.db.session.connection().execute('EXPLAIN QUERY PLAN ' + str(compiled), params):
+            detail = row[-1]
+            words = detail.split()
+            # "SCAN members" reads the whole table, "SCAN members USING [COVERING] INDEX ..." the whole index
+            scan = words[0] == 'SCAN' and words[1] not in ('CONSTANT', 'SUBQUERY')
+            full_scan = scan and not (limited and 'INDEX' in words)
+            table = words[2] if len(words) > 2 and words[1] == 'TABLE' else words[1]
+            plan.append((table, full_scan, detail))
+        return plan
+    if dialect.name == 'mysql':
+        rows = DB.db.session.connection().execute('EXPLAIN ' + str(compiled), params)
+        # type ALL reads the whole table, type index the whole index
+        return [(row['table'], row['type'] == 'ALL' or (row['type'] == 'index' and not limited),
+                 '%s: %s %s' % (row['table'], row['type'], row['key']))
+                for row in rows]
+    raise NotImplementedError("Can't explain queries on %s" % dialect.name)
+
+
+def explain_hot_queries():
+    """Return (report lines, names of the hot queries that do a full scan)"""
+    lines = []
+    failures = []
+    for name, query in HOT_QUERIES:
+        plan = explain(query())
+        full_scans = [table for table, full_scan, detail in plan if full_scan]
+        if full_scans:
+            failures.append(name)
+        lines.append("%s: %s" % (name, 'FULL SCAN of ' + ', '.join(full_scans) if full_scans else 'ok'))
+        lines.extend("    " + detail for table, full_scan, detail in plan)
+    return lines, failures
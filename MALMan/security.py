@@ -1,10 +1,11 @@
 from MALMan import app
 import MALMan.database as DB
 from flask_security import Security
-from flask import session
+from flask import g
 from flask.ext.principal import Principal
 from flask.ext.mail import Mail
 from flask.ext.login import current_user
+from sqlalchemy.orm import joinedload
 
 # configuration
 app.config['SECURITY_REGISTERABLE'] = True
@@ -29,11 +30,31 @@ security = Security(app, DB.user_datastore, confirm_register_form=RegisterForm)
 principals = Principal(app)
 
 
-@app.before_request
-def before_request():
-    # add the role and email variables to the session if they are missing but user is logged in.
-    # this happens after a session is resumed from a cookie
-    if session and ('user_id' in session) and ('email' not in session):
-        user = DB.User.query.get(current_user.id)
-        session['email'] = user.email
-        session['roles'] = [role.name for role in user.roles]
+@security.login_manager.user_loader
+def load_user(user_id):
+    """Load the logged in user and its roles in a single query, once per request"""
+    return DB.User.query.options(joinedload(DB.User.roles)).get(int(user_id))
+
+
+class MemberIdentity(object):
+    """The id, role names and membership state of the logged in user.
+    It is built once per request by current_identity() and used by the
+    permission_required and membership_required decorators."""
+
+    def __init__(self, user=None):
+        self.authenticated = user is not None
+        self.id = user.id if user else None
+        self.roles = frozenset(role.name for role in user.roles) if user else frozenset()
+        self.membership_start = user.membership_start if user else None
+        self.membership_end = user.membership_end if user else None
+        self.active_member = user.active_member if user else False
+
+
+def current_identity():
+    """Return the MemberIdentity of the current request"""
+    identity = getattr(g, 'member_identity', None)
+    if identity is None:
+        user = current_user._get_current_object()
+        identity = MemberIdentity(user if user.is_authenticated() else None)
+        g.member_identity = identity
+    return identity
@@ -1,14 +1,18 @@
 from MALMan import app
 import MALMan.database as DB
+from MALMan.security import current_identity
 
-from flask import request, flash, abort, url_for, current_app
-from flask.ext.principal import Permission, RoleNeed
-from flask.ext.login import current_user
+from flask import request, flash, abort, url_for, current_app, Response, stream_with_context
+
+from sqlalchemy import and_, or_, func, false
 
 from functools import wraps
-from urlparse import urlparse
-from math import ceil
+from itertools import chain, islice
+from xml.sax.saxutils import escape
+from decimal import Decimal
 import datetime
+import csv
+import io
 
 
 def add_confirmation(var, confirmation):
@@ -48,11 +52,12 @@ def membership_required():
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            if not current_user.is_authenticated():
+            identity = current_identity()
+            if not identity.authenticated:
                 return current_app.login_manager.unauthorized()
-            if not current_user.active_member:
-                start = current_user.membership_start
-                end = current_user.membership_end
+            if not identity.active_member:
+                start = identity.membership_start
+                end = identity.membership_end
                 if start:
                     if start > datetime.date.today():
                         flash("You will become a member in the future, but at the moment you're not. Odd.", 'error')
@@ -71,13 +76,14 @@ def permission_required(*roles):
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            if not current_user.is_authenticated():
+            identity = current_identity()
+            if not identity.authenticated:
                 return current_app.login_manager.unauthorized()
-            if not current_user.active_member:
+            if not identity.active_member:
                 flash('You need to be aproved as a member to access this resource', 'error')
                 abort(403)
             for role in roles:
-                if not Permission(RoleNeed(role)).can():
+                if role not in identity.roles:
                     flash('You need the permission \'' + str(role) +
                           '\' to access this resource.', 'error')
                     abort(403)
@@ -86,46 +92,169 @@ def permission_required(*roles):
     return wrapper
 
 
+def _keyset_condition(columns, values, older):
+    """Build the condition for rows before (older=True) or after the row with values,
+    in the descending order of columns. NULLs sort lower than any value, as they
+    do in SQLite and MySQL."""
+    def lower(column, value):
+        if value is None:
+            return false()
+        return or_(column < value, column == None)
+
+    def higher(column, value):
+        if value is None:
+            return column != None
+        return column > value
+
+    compare = lower if older else higher
+    condition = compare(columns[-1], values[-1])
+    for column, value in reversed(zip(columns[:-1], values[:-1])):
+        condition = or_(compare(column, value), and_(column == value, condition))
+    return condition
+
+
 class Pagination(object):
-    def __init__(self, page, per_page, total_count):
-        self.page = page
-        self.per_page = per_page
-        self.total_count = total_count
-
-    @property
-    def pages(self):
-        return int(ceil(self.total_count / float(self.per_page)))
-
-    @property
-    def has_prev(self):
-        return self.page > 1
-
-    @property
-    def has_next(self):
-        return self.page < self.pages
-
-    def iter_pages(self, left_edge=2, left_current=2,
-                   right_current=5, right_edge=2):
-        last = 0
-        for num in xrange(1, self.pages + 1):
-            if num <= left_edge or \
-               (num > self.page - left_current - 1 and
-                num < self.page + right_current) or \
-               num > self.pages - right_edge:
-                if last + 1 != num:
-                    yield None
-                yield num
-                last = num
-
-
-def url_for_other_page(page):
+    """Paginate a query that is shown newest first.
+
+    order_by lists the columns (or SQL expressions) the entries are sorted on in
+    descending order, the last one has to be the primary key. Pages are selected
+    with the 'older' and 'newer' request arguments, the primary key of the last or
+    first entry of the page the user came from. This filters on the order_by
+    columns instead of using OFFSET, so deep pages cost the same as the first one.
+    Page numbers (from old links) still work, but use OFFSET.
+    The total is counted with COUNT() instead of loading all entries.
+    """
+    def __init__(self, query, order_by, page=1, per_page=None):
+        self.per_page = per_page or app.config['ITEMS_PER_PAGE']
+        primary_key = order_by[-1]
+        # counting the primary key keeps the FROM clause when the query has no filter
+        self.total_count = query.order_by(None).with_entities(func.count(primary_key)).scalar()
+        older = request.args.get('older', type=int)
+        newer = request.args.get('newer', type=int)
+        cursor = older or newer
+        if cursor:
+            values = DB.db.session.query(*order_by).filter(primary_key == cursor).first()
+            if values is None:
+                abort(404)
+            query = query.filter(_keyset_condition(order_by, values, older=bool(older)))
+        if newer:
+            items = query.order_by(*[column.asc() for column in order_by]).limit(self.per_page + 1).all()
+            self.has_newer = len(items) > self.per_page
+            self.has_older = True
+            items = items[:self.per_page]
+            items.reverse()
+        else:
+            query = query.order_by(*[column.desc() for column in order_by])
+            if not older and page > 1:
+                query = query.offset((page - 1) * self.per_page)
+            items = query.limit(self.per_page + 1).all()
+            self.has_older = len(items) > self.per_page
+            self.has_newer = bool(older) or page > 1
+            items = items[:self.per_page]
+        self.items = items
+        self.newer_cursor = self.older_cursor = None
+        if items:
+            self.newer_cursor = getattr(items[0], primary_key.key)
+            self.older_cursor = getattr(items[-1], primary_key.key)
+
+
+def sales_period():
+    """Return the (start, end) dates of the sales statistics selected by the request.
+    The start and end arguments are yyyy-mm-dd dates, end is excluded. By
+    default the last 30 days are selected. Aborts with 400 if a date is invalid."""
+    today = datetime.date.today()
+    try:
+        end = request.args.get('end')
+        end = string_to_date(end) if end else today + datetime.timedelta(days=1)
+        start = request.args.get('start')
+        start = string_to_date(start) if start else end - datetime.timedelta(days=30)
+    except ValueError:
+        abort(400)
+    return start, end
+
+
+def url_for_cursor(**cursor):
     """this function is used by the pagination macro in jinja2 templates"""
     args = request.view_args.copy()
-    args['page'] = page
-    url = url_for(request.endpoint, **args)
-    query = '?' + urlparse(request.url).query
-    return url + query
-app.jinja_env.globals['url_for_other_page'] = url_for_other_page
+    args.pop('page', None)
+    for key, value in request.args.items():
+        if key not in ('older', 'newer'):
+            args[key] = value
+    args.update(cursor)
+    return url_for(request.endpoint, **args)
+app.jinja_env.globals['url_for_cursor'] = url_for_cursor
+
+
+def url_for_export(format):
+    """this function is used in jinja2 templates to link to the export of the current page, with its filters"""
+    args = dict((key, value) for key, value in request.args.items() if key not in ('older', 'newer'))
+    return url_for(request.endpoint + '_export', format=format, **args)
+app.jinja_env.globals['url_for_export'] = url_for_export
+
+
+def _csv_lines(header, rows):
+    buffer = io.BytesIO()
+    writer = csv.writer(buffer)
+    for row in chain([header], rows):
+        writer.writerow([unicode(value).encode('utf-8') if value is not None else '' for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _ods_cell(value):
+    if value is None:
+        return u'<table:table-cell/>'
+    if isinstance(value, (int, long, float, Decimal)) and not isinstance(value, bool):
+        return u'<table:table-cell office:value-type="float" office:value="%s"><text:p>%s</text:p></table:table-cell>' \
+            % (value, value)
+    if isinstance(value, datetime.date):
+        return u'<table:table-cell office:value-type="date" office:date-value="%s"><text:p>%s</text:p></table:table-cell>' \
+            % (value.isoformat(), value)
+    return u'<table:table-cell office:value-type="string"><text:p>%s</text:p></table:table-cell>' \
+        % escape(unicode(value))
+
+
+def _ods_lines(name, header, rows):
+    # a flat (single XML file) spreadsheet, unlike a zipped .ods it can be written row by row
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<office:document xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+           'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+           'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" office:version="1.2" '
+           'office:mimetype="application/vnd.oasis.opendocument.spreadsheet">'
+           '<office:body><office:spreadsheet><table:table table:name="%s">\n' % escape(name, {'"': '&quot;'}))
+    for row in chain([header], rows):
+        yield (u'<table:table-row>%s</table:table-row>\n' % u''.join(_ods_cell(value) for value in row)).encode('utf-8')
+    yield '</table:table></office:spreadsheet></office:body></office:document>\n'
+
+
+def export_response(name, format, header, rows):
+    """Return a response which streams the rows as a csv or ods spreadsheet called name
+
+    rows can be any iterable, e.g. a generator over a query using yield_per,
+    so it is never held in memory as a whole. The request context is kept
+    until the last row is sent.
+    """
+    if format == 'csv':
+        lines = _csv_lines(header, rows)
+        mimetype = 'text/csv'
+        filename = name + '.csv'
+    else:
+        lines = _ods_lines(name, header, rows)
+        mimetype = 'application/vnd.oasis.opendocument.spreadsheet-flat-xml'
+        filename = name + '.fods'
+
+    def chunks():
+        # send the rows in chunks instead of one by one
+        while True:
+            chunk = ''.join(islice(lines, 500))
+            if not chunk:
+                return
+            yield chunk
+
+    response = Response(stream_with_context(chunks()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
 
 
 def upload_attachments(request, attachments, transaction, DB):
@@ -2,34 +2,39 @@ from MALMan import app
 import MALMan.database as DB
 import MALMan.forms as forms
 from MALMan.view_utils import (add_confirmation, return_flash, accounting_categories, permission_required,
-                               membership_required, Pagination, upload_attachments, string_to_date)
+                               membership_required, Pagination, upload_attachments, string_to_date,
+                               export_response)
 
 from flask import render_template, request, redirect, flash, abort, url_for, send_file
 from flask.ext.login import current_user
 from flask.ext.uploads import UploadSet, configure_uploads
 from datetime import date, timedelta
+from decimal import Decimal
+from sqlalchemy.orm import aliased
 
 attachments = UploadSet(name='attachments')
 configure_uploads(app, attachments)
 
+_summary_cache = (None, None)
+
 
 @app.route("/accounting")
 @membership_required()
 def accounting():
-    banks = DB.Bank.query.all()
-    running_account = DB.CashTransaction.query.all()
-    running_acount_balance = sum(transaction.amount for transaction in running_account)
-    return render_template('accounting/balance.html', banks=banks, running_acount_balance=running_acount_balance)
-
-
-@app.route("/accounting/log", defaults={'page': 1}, methods=['GET', 'POST'])
-@app.route('/accounting/log/page/<int:page>', methods=['GET', 'POST'])
-@membership_required()
-def accounting_log(page):
-    log = DB.Transaction.query.filter(DB.Transaction.date_filed != None).order_by(DB.Transaction.date.desc(), DB.Transaction.bank_statement_number.desc())
+    global _summary_cache
+    # cash register entries are added and removed along with bar sales, which bump the stock version
+    versions = DB.get_versions('accounting', 'stock')
+    key = (versions['accounting'][0], versions['stock'][0], date.today().year)
+    cached_key, summary = _summary_cache
+    if cached_key != key:
+        summary = DB.accounting_summary(date.today().year)
+        _summary_cache = (key, summary)
+    return render_template('accounting/balance.html', summary=summary, year=date.today().year)
+
+
+def _filter_transactions(query, form):
+    """Filter the query by the type, bank and category of the request, and fill in the filter form"""
     banks = DB.Bank.query.order_by(DB.Bank.id).all()
-
-    form = forms.FilterTransaction()
     form.bank_id.choices = [("", "filter by bank")]
     form.bank_id.choices.extend([(str(bank.id), bank.name) for bank in banks])
     form.category_id.choices = [("", "filter by category")]
@@ -39,13 +44,24 @@ def accounting_log(page):
         field = request.args.get(item)
         if field:
             setattr(form[item], 'data', field)
-            log = log.filter(getattr(DB.Transaction, item) == field)
+            query = query.filter(getattr(DB.Transaction, item) == field)
+    return query
+
 
-    item_count = len(log.all())
-    log = log.paginate(page, app.config['ITEMS_PER_PAGE'], False).items
+@app.route("/accounting/log", defaults={'page': 1}, methods=['GET', 'POST'])
+@app.route('/accounting/log/page/<int:page>', methods=['GET', 'POST'])
+@membership_required()
+def accounting_log(page):
+    form = forms.FilterTransaction()
+    log = DB.Transaction.query.options(*DB.LOAD_PROFILES['accounting log']) \
+        .filter(DB.Transaction.date_filed != None)
+    log = _filter_transactions(log, form)
+
+    order_by = [DB.Transaction.date, DB.Transaction.bank_statement_number, DB.Transaction.id]
+    pagination = Pagination(log, order_by, page)
+    log = pagination.items
     if not log and page != 1:
         abort(404)
-    pagination = Pagination(page, app.config['ITEMS_PER_PAGE'], item_count)
 
     if form.validate_on_submit():
         args = request.view_args.copy()
@@ -56,6 +72,39 @@ def accounting_log(page):
     return render_template('accounting/log.html', log=log, form=form, pagination=pagination)
 
 
+@app.route("/accounting/log.<any(csv, ods):format>")
+@membership_required()
+def accounting_log_export(format):
+    filed_by = aliased(DB.User)
+    query = DB.db.session.query(DB.Transaction.id, DB.Transaction.date, DB.Transaction.advance_date,
+                                DB.Transaction.is_revenue, DB.Transaction.amount, DB.Transaction.to_from,
+                                DB.Transaction.description, DB.AccountingCategory.name.label('category'),
+                                DB.Bank.name.label('bank'), DB.Transaction.bank_statement_number,
+                                DB.Transaction.date_filed, filed_by.name.label('filed_by')) \
+        .outerjoin(DB.AccountingCategory, DB.AccountingCategory.id == DB.Transaction.category_id) \
+        .outerjoin(DB.Bank, DB.Bank.id == DB.Transaction.bank_id) \
+        .outerjoin(filed_by, filed_by.id == DB.Transaction.filed_by_id) \
+        .filter(DB.Transaction.date_filed != None)
+    query = _filter_transactions(query, forms.FilterTransaction())
+    query = query.order_by(DB.Transaction.date, DB.Transaction.id).yield_per(1000)
+    finances = 'finances' in current_user.roles
+
+    header = ['#', 'Transaction date', 'Advance date', 'Amount', 'to/from', 'Description', 'Category', 'Bank']
+    if finances:
+        header.extend(['Bank statement', 'Date filed', 'Filed by'])
+
+    def rows():
+        for transaction in query:
+            amount = transaction.amount if transaction.is_revenue else -transaction.amount
+            row = [transaction.id, transaction.date, transaction.advance_date, amount, transaction.to_from,
+                   transaction.description, transaction.category, transaction.bank]
+            if finances:
+                row.extend([transaction.bank_statement_number, transaction.date_filed, transaction.filed_by])
+            yield row
+
+    return export_response('transactions', format, header, rows())
+
+
 @app.route("/accounting/accounting/remove_attachment_<transaction_id>_<attachment_id>", methods=['GET', 'POST'])
 @permission_required('finances')
 def accounting_remove_attachment(transaction_id, attachment_id):
@@ -83,13 +132,11 @@ def accounting_remove_attachment(transaction_id, attachment_id):
 @app.route('/accounting/cashlog/page/<int:page>')
 @permission_required('finances')
 def accounting_cashlog(page):
-    log = DB.CashTransaction.query.order_by(DB.CashTransaction.id.desc())
-
-    item_count = len(log.all())
-    log = log.paginate(page, app.config['ITEMS_PER_PAGE'], False).items
+    log = DB.CashTransaction.query.options(*DB.LOAD_PROFILES['cash log'])
+    pagination = Pagination(log, [DB.CashTransaction.id], page)
+    log = pagination.items
     if not log and page != 1:
         abort(404)
-    pagination = Pagination(page, app.config['ITEMS_PER_PAGE'], item_count)
 
     return render_template('accounting/cashlog.html', log=log, pagination=pagination)
 
@@ -107,6 +154,7 @@ def accounting_request_reimbursement():
                                      reimbursement_comments=request.form["comments"],
                                      to_from=current_user.name)
         DB.db.session.add(transaction)
+        DB.bump_version('accounting')
         DB.db.session.commit()
 
         upload_attachments(request, attachments, transaction, DB)
@@ -126,7 +174,7 @@ def accounting_attachment(filename):
 @app.route("/accounting/approve_reimbursements")
 @permission_required('finances')
 def accounting_approve_reimbursements():
-    requests = DB.Transaction.query.filter_by(date_filed=None)
+    requests = DB.Transaction.query.options(*DB.LOAD_PROFILES['reimbursement requests']).filter_by(date_filed=None)
     return render_template('accounting/list_reimbursements.html', requests=requests)
 
 
@@ -140,6 +188,10 @@ def accounting_approve_reimbursement(transaction_id):
     form.category_id.choices = accounting_categories(IN=False)
     del form.is_revenue
     if form.validate_on_submit():
+        facturation_date = string_to_date(request.form["date"])
+        if DB.is_closed(facturation_date.year):
+            flash("the books of %i are closed" % facturation_date.year, "error")
+            return redirect(request.url)
         transaction.date = string_to_date(request.form["date"])
         transaction.facturation_date = string_to_date(request.form["date"])
         transaction.amount = request.form["amount"]
@@ -150,6 +202,7 @@ def accounting_approve_reimbursement(transaction_id):
         transaction.bank_statement_number = request.form["bank_statement_number"]
         transaction.date_filed = date.today()
         transaction.filed_by_id = current_user.id
+        DB.bump_version('accounting')
         DB.db.session.commit()
 
         upload_attachments(request, attachments, transaction, DB)
@@ -171,6 +224,9 @@ def accounting_add_transaction():
             facturation_date = string_to_date(request.form["facturation_date"])
         else:
             facturation_date = string_to_date(request.form["date"])
+        if DB.is_closed(facturation_date.year):
+            flash("the books of %i are closed" % facturation_date.year, "error")
+            return redirect(request.url)
         # convert empty string to None if necessary to prevent a crash
         if request.form["bank_statement_number"] == '':
             bank_statement_number = None
@@ -188,6 +244,7 @@ def accounting_add_transaction():
                                      date_filed=date.today(),
                                      filed_by_id=current_user.id)
         DB.db.session.add(transaction)
+        DB.bump_version('accounting')
         DB.db.session.commit()
 
         upload_attachments(request, attachments, transaction, DB)
@@ -212,11 +269,12 @@ def topup_bar_account(transaction_id):
     form.user_id.choices = [(user.id, user.name) for user in users.order_by('name').all()]
     transaction = DB.Transaction.query.get(transaction_id)
     if form.validate_on_submit():
-        item = DB.BarAccountLog(user_id=request.form["user_id"],
+        user = users.get(request.form["user_id"])
+        item = DB.BarAccountLog(user_id=user.id,
                                 transaction_id=transaction_id)
         DB.db.session.add(item)
+        user.add_to_bar_account(transaction.amount)
         DB.db.session.commit()
-        user = users.get(request.form["user_id"])
         flash(u"\u20AC" + str(transaction.amount) + " was added to " + user.name + "'s bar account", "confirmation")
         return redirect(url_for('accounting_log'))
     return render_template('accounting/topup_bar_account.html', form=form, transaction=transaction)
@@ -231,6 +289,12 @@ def accounting_edit_transaction(transaction_id):
     form.bank_id.choices = [(bank.id, bank.name) for bank in banks]
     form.category_id.choices = accounting_categories()
     if form.validate_on_submit():
+        facturation_dates = [transaction.facturation_date,
+                             string_to_date(request.form.get('facturation_date') or request.form.get('date'))]
+        for year in set(facturation_date.year for facturation_date in facturation_dates if facturation_date):
+            if DB.is_closed(year):
+                flash("the books of %i are closed, its transactions can't be edited" % year, "error")
+                return redirect(request.url)
         confirmation = app.config['CHANGE_MSG']
         atributes = ['date', 'facturation_date', 'is_revenue', 'amount', 'to_from', 'description',
                      'category_id', 'bank_id', 'bank_statement_number']
@@ -247,10 +311,16 @@ def accounting_edit_transaction(transaction_id):
             if str(new_value) != str(old_value):
                 if atribute == 'facturation_date' and new_value == '':
                     new_value = request.form.get('date')
+                if atribute == 'amount':
+                    # keep the stored balance of bar accounts topped up by this transaction correct
+                    for topup in DB.BarAccountLog.query.filter_by(transaction_id=transaction.id):
+                        topup.user.add_to_bar_account(Decimal(new_value) - old_value)
                 setattr(transaction, atribute, new_value)
                 confirmation = add_confirmation(confirmation, str(atribute) + " = " + str(new_value) +
                                                 " (was " + str(old_value) + ")")
             transaction.date_filed
+        if confirmation != app.config['CHANGE_MSG']:
+            DB.bump_version('accounting')
         DB.db.session.commit()
 
         uploadconfirmation = upload_attachments(request, attachments, transaction, DB)
@@ -265,7 +335,7 @@ def accounting_edit_transaction(transaction_id):
 @app.route('/accounting/membershipfees/page/<int:page>')
 @permission_required('finances')
 def accounting_membershipfees(page):
-    log = DB.MembershipFee.query
+    log = DB.MembershipFee.query.options(*DB.LOAD_PROFILES['membership fees'])
     users = DB.User.query
 
     form = forms.FilterMembershipFees()
@@ -277,11 +347,10 @@ def accounting_membershipfees(page):
         log = log.filter_by(user_id=user)
         setattr(form.user, 'data', user)
 
-    item_count = len(log.all())
-    log = log.paginate(page, app.config['ITEMS_PER_PAGE'], False).items
+    pagination = Pagination(log, [DB.MembershipFee.id], page)
+    log = pagination.items
     if not log and page != 1:
         abort(404)
-    pagination = Pagination(page, app.config['ITEMS_PER_PAGE'], item_count)
 
     if form.validate_on_submit():
         args = request.view_args.copy()
@@ -307,36 +376,58 @@ def file_membershipfee(transaction_id):
                                 transaction_id=transaction_id,
                                 until=payeduntil)
         DB.db.session.add(item)
-        DB.db.session.commit()
         user = users.get(request.form["user_id"])
+        user.pay_membership_until(payeduntil)
+        DB.db.session.commit()
         flash(user.name + "'s membership dues are paid until then end of " + payeduntil.strftime('%Y-%m'), "confirmation")
         return redirect(url_for('accounting_log'))
 
     return render_template('accounting/file_membershipfee.html', form=form, transaction=transaction)
 
 
-@app.route("/accounting/kasboek", methods=['GET', 'POST'])
-@membership_required()
-def accounting_kasboek():
-    log = DB.Transaction.query.filter(DB.Transaction.facturation_date != None).order_by(DB.Transaction.facturation_date.asc())
-    banks = DB.Bank.query.order_by(DB.Bank.id).all()
-    years = [transaction.facturation_date.year for transaction in log]
-    years = list(set(years))  # remove duplicates
-    years = sorted(years, reverse=True)
+def _months_overdue(user, today):
+    """Return the number of started months since the membership dues of user were paid until"""
+    paid_until = user.membership_paid_until or user.membership_start - timedelta(days=1)
+    return (today.year - paid_until.year) * 12 + today.month - paid_until.month
 
-    form = forms.FilterKasboek()
+
+@app.route("/accounting/overdue_membershipfees")
+@permission_required('finances')
+def accounting_overdue_membershipfees():
+    today = date.today()
+    members = [(user, _months_overdue(user, today)) for user in DB.overdue_members(today)]
+    overdue = [(user, months, months * (user.membership_dues or 0)) for user, months in members]
+    return render_template('accounting/overdue_membershipfees.html', overdue=overdue)
+
+
+def _kasboek(form):
+    """Return the (entries, totals) of the kasboek selected by the request, and fill in its filter form"""
+    banks = DB.Bank.query.order_by(DB.Bank.id).all()
+    years = DB.transaction_years()
 
     form.bank.choices = [(bank.name, bank.name) for bank in banks]
     form.year.choices = [(year, year) for year in years]
 
     # filter by bank and year
     bank_name = request.args.get('bank') or banks[0].name
-    log = log.filter(DB.Transaction.bank.has(name=bank_name)).all()
+    bank = next((bank for bank in banks if bank.name == bank_name), None)
+    if not bank:
+        abort(404)
     form.bank.data = bank_name
-    if years:
-        year = int(request.args.get('year') or years[0])
-        log = [transaction for transaction in log if transaction.date.year == year]
-        form.year.data = year
+    if not years:
+        return iter([]), None
+    year = int(request.args.get('year') or years[0])
+    form.year.data = year
+    if DB.is_closed(year):
+        return DB.closed_kasboek(year, bank.id)
+    return DB.kasboek(bank.id, date(year, 1, 1), date(year + 1, 1, 1))
+
+
+@app.route("/accounting/kasboek", methods=['GET', 'POST'])
+@membership_required()
+def accounting_kasboek():
+    form = forms.FilterKasboek()
+    log, totals = _kasboek(form)
 
     if form.validate_on_submit():
         args = request.view_args.copy()
@@ -344,19 +435,32 @@ def accounting_kasboek():
         args['year'] = request.form['year']
         return redirect(url_for('accounting_kasboek', **args))
 
-    return render_template('accounting/kasboek.html', log=log, banks=banks, form=form)
+    return render_template('accounting/kasboek.html', log=list(log), totals=totals, form=form)
 
 
-@app.route("/accounting/dagboek", methods=['GET', 'POST'])
+@app.route("/accounting/kasboek.<any(csv, ods):format>")
 @membership_required()
-def accounting_dagboek():
-    log = DB.Transaction.query.filter(DB.Transaction.facturation_date != None).order_by(DB.Transaction.facturation_date.asc())
-    banks = DB.Bank.query.order_by(DB.Bank.id).all()
-    years = [transaction.facturation_date.year for transaction in log]
-    years = list(set(years))  # remove duplicates
-    years = sorted(years, reverse=True)
+def accounting_kasboek_export(format):
+    form = forms.FilterKasboek()
+    log, totals = _kasboek(form)
+    header = ['#', 'Facturatie Datum', 'Omschrijving', 'FactuurNr', 'Inkomsten', 'Uitgaven', 'Totalen']
 
-    form = forms.FilterDagboek()
+    def rows():
+        for number, transaction in enumerate(log, 1):
+            revenue = transaction.amount if transaction.is_revenue else None
+            expense = None if transaction.is_revenue else transaction.amount
+            yield [number, transaction.facturation_date, transaction.description, None,
+                   revenue, expense, transaction.running_total]
+        if totals:
+            yield [None, None, None, None, totals.revenue, totals.expenses, totals.balance]
+
+    name = 'kasboek-%s-%s' % (form.bank.data, form.year.data)
+    return export_response(name, format, header, rows())
+
+
+def _dagboek(form):
+    """Return the (entries, banks, categories) of the dagboek selected by the request, and fill in its filter form"""
+    years = DB.transaction_years()
     form.year.choices = [(year, year) for year in years]
 
     # filter by type
@@ -366,44 +470,24 @@ def accounting_dagboek():
     else:
         is_revenue = False
     form.is_revenue.data = type
-    # we don't remove transactions yet because we need all of them for the count below
 
     # filter by year
-    if years:
-        year = int(request.args.get('year') or years[0])
-        log = [transaction for transaction in log if transaction.facturation_date.year == year]
-        form.year.data = year
-
-    # We build the list over here instead of in the template because the numbering is too complex
-    transactions = []
-    used_banks = []
-    used_categories = []
-    for entry in log:
-        transaction = {}
-        transaction['id'] = entry.id
-        transaction['facturation_date'] = entry.facturation_date
-        transaction['description'] = entry.description
-        transaction['amount'] = entry.amount
-        for bank in banks:
-            if entry.bank_id == bank.id:
-                # get the transactions with the same bank, sort them by
-                # facturation date and find out how many transactions precede
-                # the current transaction
-                transactions_same_bank = [item for item in log if item.bank_id == bank.id]
-                transactions_same_bank.sort(key=lambda k: k.facturation_date)
-                for position, item in enumerate(transactions_same_bank):
-                    if item.id == entry.id:
-                        count = position + 1
-                transaction['number_' + str(bank.name)] = count
-                transaction['bank_' + str(bank.name)] = entry.amount
-                used_banks.append(bank.name)
-        transaction['category_' + entry.category.legal_category] = entry.amount
-        if entry.is_revenue == is_revenue:
-            transactions.append(transaction)
-            used_categories.append(entry.category.legal_category)
-    used_banks = set(used_banks)
-    used_categories = list(set(used_categories))
-    used_categories.sort()
+    if not years:
+        return iter([]), [], []
+    year = int(request.args.get('year') or years[0])
+    form.year.data = year
+    if DB.is_closed(year):
+        entries, banks, categories = DB.closed_dagboek(year, is_revenue)
+    else:
+        entries, banks, categories = DB.dagboek(date(year, 1, 1), date(year + 1, 1, 1), is_revenue)
+    return entries, sorted(banks), categories
+
+
+@app.route("/accounting/dagboek", methods=['GET', 'POST'])
+@membership_required()
+def accounting_dagboek():
+    form = forms.FilterDagboek()
+    transactions, used_banks, used_categories = _dagboek(form)
 
     if form.validate_on_submit():
         args = request.view_args.copy()
@@ -411,5 +495,56 @@ def accounting_dagboek():
         args['year'] = request.form['year']
         return redirect(url_for('accounting_dagboek', **args))
 
-    return render_template('accounting/dagboek.html', transactions=transactions,
+    return render_template('accounting/dagboek.html', transactions=list(transactions),
                            form=form, banks=used_banks, categories=used_categories)
+
+
+@app.route("/accounting/dagboek.<any(csv, ods):format>")
+@membership_required()
+def accounting_dagboek_export(format):
+    form = forms.FilterDagboek()
+    transactions, banks, categories = _dagboek(form)
+    header = ['Nr', 'Datum', 'Omschrijving']
+    for bank in banks:
+        header.extend([bank + ' Nr', bank + ' Bedrag'])
+    header.append('Totaal')
+    header.extend(categories)
+    amounts = ['bank_' + bank for bank in banks] + ['amount'] + ['category_' + category for category in categories]
+
+    def rows():
+        totals = dict((key, 0) for key in amounts)
+        for number, transaction in enumerate(transactions, 1):
+            row = [number, transaction['facturation_date'], transaction['description']]
+            for bank in banks:
+                row.extend([transaction.get('number_' + bank), transaction.get('bank_' + bank)])
+            row.append(transaction['amount'])
+            row.extend(transaction.get('category_' + category) for category in categories)
+            for key in amounts:
+                totals[key] += transaction.get(key) or 0
+            yield row
+        footer = [None, None, None]
+        for bank in banks:
+            footer.extend([None, totals['bank_' + bank]])
+        footer.append(totals['amount'])
+        footer.extend(totals['category_' + category] for category in categories)
+        yield footer
+
+    name = 'dagboek-%s-%s' % (form.is_revenue.data, form.year.data)
+    return export_response(name, format, header, rows())
+
+
+@app.route("/accounting/close_year", methods=['GET', 'POST'])
+@permission_required('finances')
+def accounting_close_year():
+    closed_years = DB.ClosedYear.query.order_by(DB.ClosedYear.year.desc()).all()
+    closed = set(closed_year.year for closed_year in closed_years)
+    # the current year can't be closed yet
+    open_years = [year for year in DB.transaction_years() if year < date.today().year and year not in closed]
+    form = forms.CloseYear()
+    form.year.choices = [(year, year) for year in open_years]
+    if form.validate_on_submit():
+        count = DB.close_year(form.year.data, current_user.id)
+        DB.db.session.commit()
+        flash("the books of %i were closed with %i transactions" % (form.year.data, count), "confirmation")
+        return redirect(url_for('accounting_close_year'))
+    return render_template('accounting/close_year.html', form=form, closed_years=closed_years)
@@ -2,7 +2,7 @@ from MALMan import app
 import MALMan.database as DB
 import MALMan.forms as forms
 from MALMan.view_utils import (add_confirmation, return_flash, permission_required,
-                               membership_required, Pagination)
+                               membership_required, Pagination, export_response, sales_period)
 
 from flask import render_template, request, redirect, flash, abort, url_for
 from flask.ext.login import current_user
@@ -10,22 +10,25 @@ from wtforms import validators
 from flask_wtf import Form
 from wtforms.fields import SubmitField, FormField, BooleanField, IntegerField
 
+from datetime import datetime
+
 
 @app.route("/bar")
 @membership_required()
 def bar():
-    items = DB.StockItem.query.filter_by(active=True).order_by(DB.StockItem.name.asc()).all()
-    return render_template('bar/list_items.html', items=items)
+    items = DB.StockItem.query.options(*DB.LOAD_PROFILES['stock list']) \
+        .filter_by(active=True).order_by(DB.StockItem.name.asc()).all()
+    stock = DB.stock_levels()
+    return render_template('bar/list_items.html', items=items, stock=stock)
 
 
 @app.route("/bar/activate_stockitems", methods=['GET', 'POST'])
 @permission_required('bar')
 def bar_activate_stockitems():
-    stockitems = DB.StockItem.query.filter_by(active=False).all()
-    for stockitem in stockitems:
-        setattr(forms.BarActivateItem, 'activate_' + str(stockitem.id),
-                BooleanField('activate item'))
-    form = forms.BarActivateItem()
+    stockitems = DB.StockItem.query.options(*DB.LOAD_PROFILES['stock list']).filter_by(active=False).all()
+    form_class = forms.stock_item_form_class(forms.BarActivateItem, stockitems,
+        lambda stockitem: ('activate_' + str(stockitem.id), BooleanField('activate item')))
+    form = form_class()
 
     if form.validate_on_submit():
         confirmation = 'the following stockitem\'s status were set to "active": '
@@ -34,6 +37,7 @@ def bar_activate_stockitems():
             if new_value != stockitem.active:
                 stockitem.active = True
                 confirmation = confirmation + stockitem.name + ", "
+        DB.bump_version('catalogue')
         DB.db.session.commit()
         return_flash(confirmation)
         return redirect(request.url)
@@ -50,6 +54,7 @@ def bar_remove_item(item_id):
         new_value = 'activate_' + str(stockitem.id) in request.form
         if new_value != stockitem.active:
             stockitem.active = False
+            DB.bump_version('catalogue')
             DB.db.session.commit()
             flash('The item "' + stockitem.name + '" status was set to "inactive"', 'confirmation')
         return redirect(url_for('bar'))
@@ -60,24 +65,29 @@ def bar_remove_item(item_id):
 @permission_required('bar')
 def bar_edit_item_amounts():
     items = DB.StockItem.query.filter_by(active=True).order_by(DB.StockItem.name.asc()).all()
-    for item in items:
-        setattr(forms.BarEditAmounts, 'amount_' + str(item.id),
-                IntegerField(item.name, [validators.NumberRange(min=0,
-                             message='please enter a positive number')],
-                             default=item.stock))
-    form = forms.BarEditAmounts()
+    form_class = forms.stock_item_form_class(forms.BarEditAmounts, items,
+        lambda item: ('amount_' + str(item.id),
+                      IntegerField(item.name, [validators.NumberRange(min=0,
+                                   message='please enter a positive number')])))
+    stock = DB.stock_levels([item.id for item in items])
+    form = form_class(data=dict(('amount_' + str(item.id), stock.get(item.id, 0)) for item in items))
     if form.validate_on_submit():
+        # a stocktake: all counts are compared and corrected in a single DB transaction
+        counts = dict((item.id, form['amount_' + str(item.id)].data) for item in items)
+        variances = DB.stocktake(counts, current_user.id)
         confirmation = app.config['CHANGE_MSG']
-        for item in items:
-            if int(request.form["amount_" + str(item.id)]) != int(item.stock):
-                changes = DB.BarLog(item_id=item.id,
-                                    amount=int(request.form["amount_" + str(item.id)]) - int(item.stock),
-                                    user_id=current_user.id,
-                                    transaction_type="correction")
-                DB.db.session.add(changes)
-                DB.db.session.commit()
-                confirmation = add_confirmation(confirmation, "stock " + item.name + " = " +
-                                                request.form["amount_" + str(item.id)])
+        if variances:
+            items_by_id = dict((item.id, item) for item in items)
+            for item_id, expected, counted in variances:
+                confirmation = add_confirmation(confirmation, "stock %s = %i (was %i, %+i)" %
+                                                (items_by_id[item_id].name, counted, expected, counted - expected))
+            units = sum(counted - expected for item_id, expected, counted in variances)
+            value = sum((counted - expected) * (items_by_id[item_id].price or 0)
+                        for item_id, expected, counted in variances)
+            confirmation = add_confirmation(confirmation, "%i item(s) corrected, a variance of %+i unit(s) "
+                                            "worth %s" % (len(variances), units, value))
+            DB.bump_version('stock')
+            DB.db.session.commit()
         return_flash(confirmation)
         return redirect(request.url)
     return render_template('bar/edit_amounts.html', form=form)
@@ -88,10 +98,9 @@ def bar_edit_item_amounts():
 def bar_edit_items():
     items = DB.StockItem.query.filter_by(active=True).order_by(DB.StockItem.name.asc()).all()
     categories = DB.StockCategory.query.all()
-    for item in items:
-        setattr(forms.BarEdit, str(item.id),
-                FormField(forms.BarEditItem, default=item, separator='_'))
-    form = forms.BarEdit()
+    form_class = forms.stock_item_form_class(forms.BarEdit, items,
+        lambda item: (str(item.id), FormField(forms.BarEditItem, separator='_')))
+    form = form_class(data=dict((str(item.id), item) for item in items))
     for item in form:
         if item.name != 'csrf_token' and item.name != 'submit':
             item.category_id.choices = [(category.id, category.name) for category in categories]
@@ -109,6 +118,7 @@ def bar_edit_items():
                     new_value = request.form[str(item.id) + '_' + atribute]
                 if str(old_value) != str(new_value):
                     setattr(item, atribute, new_value)
+                    DB.bump_version('catalogue')
                     DB.db.session.commit()
                     if atribute == "name":
                         confirmation = add_confirmation(confirmation,
@@ -134,7 +144,9 @@ def bar_edit_items():
 def bar_stockup_josto():
     # get all active stock items from josto that need stocking up
     items = DB.StockItem.query.filter_by(active=True, josto=True).order_by(DB.StockItem.name.asc()).all()
-    items = [item for item in items if item.stockup > 0]
+    stock = DB.stock_levels([item.id for item in items])
+    stockup = dict((item.id, item.stock_max - stock[item.id]) for item in items)
+    items = [item for item in items if stockup[item.id] > 0]
 
     # we need to redefine this form everytime the view gets called,
     # otherwise the setattr's are caried over
@@ -145,7 +157,7 @@ def bar_stockup_josto():
                 str(item.id),
                 FormField(forms.StockupJostoFormMixin,
                           label=item.name,
-                          default={'amount': item.stockup}))
+                          default={'amount': stockup[item.id]}))
     form = StockupForm()
 
     if form.validate_on_submit():
@@ -158,8 +170,10 @@ def bar_stockup_josto():
                     changes = DB.BarLog(item_id=item.id,
                                         amount=amount,
                                         user_id=current_user.id,
-                                        transaction_type="stock up")
+                                        transaction_type="stock up",
+                                        datetime=datetime.now())
                     DB.db.session.add(changes)
+                    DB.bump_version('stock')
                     DB.db.session.commit()
                     confirmation = add_confirmation(confirmation, "stock " +
                                                     item.name + " = +" + str(amount))
@@ -195,10 +209,12 @@ def bar_stockup_own():
                 changes = DB.BarLog(item_id=item.id,
                                     amount=amount,
                                     user_id=current_user.id,
-                                    transaction_type="stock up")
+                                    transaction_type="stock up",
+                                    datetime=datetime.now())
                 DB.db.session.add(changes)
                 confirmation_string = "%s (+%i)" % (item.name, amount)
                 item_confirmation.append(confirmation_string)
+        DB.bump_version('stock')
         DB.db.session.commit()
         if item_confirmation:
             confirmation = "These stockitems were stocked up: "
@@ -214,23 +230,46 @@ def bar_stockup_own():
 @app.route("/bar/log/page/<int:page>")
 @permission_required('bar')
 def bar_log(page):
-    log = DB.BarLog.query.order_by(DB.BarLog.datetime.desc())
-    item_count = len(log.all())
-    log = log.paginate(page, app.config['ITEMS_PER_PAGE'], False).items
+    order_by = [DB.BarLog.datetime, DB.BarLog.id]
+    pagination = Pagination(DB.BarLog.query.options(*DB.LOAD_PROFILES['bar log']), order_by, page)
+    log = pagination.items
     if not log and page != 1:
         abort(404)
-    pagination = Pagination(page, app.config['ITEMS_PER_PAGE'], item_count)
     return render_template('bar/log.html', log=log, pagination=pagination)
 
 
+@app.route("/bar/log.<any(csv, ods):format>")
+@permission_required('bar')
+def bar_log_export(format):
+    query = DB.db.session.query(DB.BarLog.datetime, DB.BarLog.transaction_type,
+                                DB.StockItem.name.label('item'), DB.BarLog.amount, DB.BarLog.price,
+                                DB.User.name.label('user')) \
+        .outerjoin(DB.StockItem, DB.StockItem.id == DB.BarLog.item_id) \
+        .outerjoin(DB.User, DB.User.id == DB.BarLog.user_id) \
+        .order_by(DB.BarLog.id) \
+        .yield_per(1000)
+    header = ['date', 'type', 'item', 'stock effect', 'financial effect', 'user']
+    rows = ([entry.datetime, entry.transaction_type, entry.item, entry.amount, entry.price, entry.user or 'cash']
+            for entry in query)
+    return export_response('stock_log', format, header, rows)
+
+
 @app.route("/bar/reverse_<int:item_id>", methods=['GET'])
 @permission_required('bar')
 def bar_reverse(item_id):
     barlog_entry = DB.BarLog.query.get(item_id)
     # barlog_entry.bar_account_entry and barlog_entry.cash_transaction are lists, not elements
-    [DB.db.session.delete(transaction) for transaction in barlog_entry.bar_account_transaction]
+    # stock snapshots taken after this entry was logged include it, so take it out of those too
+    DB.StockSnapshot.query.filter(DB.StockSnapshot.item_id == barlog_entry.item_id,
+                                  DB.StockSnapshot.last_log_id >= barlog_entry.id) \
+        .update({DB.StockSnapshot.amount: DB.StockSnapshot.amount - barlog_entry.amount},
+                synchronize_session=False)
+    for transaction in barlog_entry.bar_account_transaction:
+        transaction.user.add_to_bar_account(barlog_entry.price)
+        DB.db.session.delete(transaction)
     [DB.db.session.delete(transaction) for transaction in barlog_entry.cash_transaction]
     DB.db.session.delete(barlog_entry)
+    DB.bump_version('stock')
     DB.db.session.commit()
     flash('The change was reverted', 'confirmation')
     prev = request.args.get('prev')
@@ -239,6 +278,17 @@ def bar_reverse(item_id):
     return redirect(url_for('bar_log'))
 
 
+@app.route("/bar/stats")
+@membership_required()
+def bar_stats():
+    start, end = sales_period()
+    items = DB.sales_per_item(start, end).all()
+    days = DB.sales_per_day(start, end).all()
+    return render_template('bar/stats.html', start=start, end=end, items=items, days=days,
+                           sold=sum(item.sold for item in items),
+                           revenue=sum(item.revenue for item in items))
+
+
 @app.route("/bar/add_item", methods=['GET', 'POST'])
 @permission_required('bar')
 def bar_add_item():
@@ -255,6 +305,7 @@ def bar_add_item():
                             josto=josto,
                             active=1)
         DB.db.session.add(item)
+        DB.bump_version('catalogue')
         DB.db.session.commit()
         flash("added stock item: " + request.form["name"], "confirmation")
         return redirect(url_for('bar'))
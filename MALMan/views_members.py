@@ -13,17 +13,17 @@ import datetime
 @app.route("/members")
 @membership_required()
 def members():
-    users = DB.User.query.filter_by(active_member=True)
+    users = DB.User.query.options(*DB.LOAD_PROFILES['members list']).filter_by(active_member=True)
     return render_template('members/members.html', users=users)
 
 
 @app.route("/members/approve_new_members", methods=['GET', 'POST'])
 @permission_required('members')
 def members_approve_new_members():
-    new_members = DB.User.query.filter_by(membership_start=None)
-    for user in new_members:
-        setattr(forms.NewMembers, 'activate_' + str(user.id), BooleanField('activate user'))
-    form = forms.NewMembers()
+    new_members = DB.User.query.filter_by(membership_start=None).all()
+    form_class = forms.form_class(forms.NewMembers, tuple(user.id for user in new_members),
+        lambda: [('activate_' + str(user.id), BooleanField('activate user')) for user in new_members])
+    form = form_class()
     if form.validate_on_submit():
         confirmation = app.config['CHANGE_MSG']
         for user in new_members:
@@ -70,16 +70,11 @@ def members_remove_member(user_id):
 def members_edit_member(user_id):
     userdata = DB.User.query.get(user_id)
     roles = DB.Role.query.all()
-    # add roles to form
-    for role in roles:
-        # check the checkbox if the user has the role
-        if role in userdata.roles:
-            setattr(forms.MembersEditAccount, 'perm_' + str(role.name),
-                    BooleanField(role.name, default='y'))
-        else:
-            setattr(forms.MembersEditAccount, 'perm_' + str(role.name),
-                    BooleanField(role.name))
-    form = forms.MembersEditAccount(obj=userdata)
+    # add roles to form, the checkbox is checked if the user has the role
+    form_class = forms.form_class(forms.MembersEditAccount, tuple(role.name for role in roles),
+        lambda: [('perm_' + str(role.name), BooleanField(role.name)) for role in roles])
+    form = form_class(obj=userdata, data=dict(('perm_' + str(role.name), role in userdata.roles)
+                                              for role in roles))
     del form.email
     if form.validate_on_submit():
         confirmation = app.config['CHANGE_MSG']
@@ -28,7 +28,7 @@ def index():
 @app.route("/my_account/bar_account")
 @membership_required()
 def account_bar_account():
-    log = DB.BarAccountLog.query.filter_by(user_id=current_user.id)
+    log = DB.BarAccountLog.query.options(*DB.LOAD_PROFILES['bar account log']).filter_by(user_id=current_user.id)
     log = sorted(log, key=lambda i: i.datetime, reverse=True)  # sort descending
     return render_template('my_account/bar_account_log.html', log=log)
 
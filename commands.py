@@ -1,10 +1,11 @@
-from MALMan import app
+from MALMan import app, benchmark, schema
 import MALMan.database as DB
 
 from flask.ext.script import Manager
 from flask_security.utils import encrypt_password
 
 from datetime import date
+import json
 
 manager = Manager(app)
 
@@ -53,6 +54,66 @@ def confirm_email(email):
     DB.db.session.commit()
     return "%s has been confirmed and can login now" % email
 
+@manager.command
+def reconcile_bar_accounts():
+    """Recalculates the stored bar account balances from the bar account log and reports any drift"""
+
+    drift = []
+    calculated_balances = dict((row.user_id, row.balance) for row in DB.bar_account_balances())
+    for user in DB.User.query.order_by(DB.User.id):
+        calculated = calculated_balances[user.id]
+        stored = user.bar_account_balance or 0
+        if calculated != stored:
+            drift.append("%s: stored %s, calculated %s" % (user.email, stored, calculated))
+            user.bar_account_balance = calculated
+    DB.db.session.commit()
+    if not drift:
+        return "All bar account balances are correct"
+    return "Corrected %i bar account balance(s):\n%s" % (len(drift), "\n".join(drift))
+
+
+@manager.command
+def snapshot_stock():
+    """Stores the current stock level of all stock items, run this periodically (e.g. from cron)"""
+
+    count = DB.take_stock_snapshot()
+    DB.db.session.commit()
+    return "Stored the stock level of %i stock item(s)" % count
+
+
+@manager.option('-k', '--keep', dest='keep', type=int, default=10000,
+                help='number of the newest changes to keep')
+def prune_sync_changes(keep):
+    """Deletes old bar terminal sync changes, run this periodically (e.g. from cron)"""
+
+    count = DB.prune_sync_changes(keep)
+    DB.db.session.commit()
+    return "Deleted %i sync change(s)" % count
+
+
+@manager.command
+def rebuild_daily_rollup():
+    """Recalculates the daily sales rollup from the whole bar log"""
+
+    count = DB.rebuild_daily_rollup()
+    DB.db.session.commit()
+    return "Rebuilt the daily sales rollup with %i row(s)" % count
+
+
+@manager.command
+def close_year(year):
+    """Freezes the kasboek and dagboek of a past year and blocks changes to its transactions"""
+
+    year = int(year)
+    if year >= date.today().year:
+        return "Only past years can be closed"
+    if DB.is_closed(year):
+        return "%i is already closed" % year
+    count = DB.close_year(year)
+    DB.db.session.commit()
+    return "Closed %i with %i transaction(s)" % (year, count)
+
+
 @manager.command
 def test():
     """Test the build, without starting a web service"""
@@ -72,6 +133,8 @@ def init_database():
     """Adds all tables and default data to the database"""
     from MALMan.database import db
     db.create_all()
+    # the new tables already have the latest schema, this only records the migrations as applied
+    schema.migrate()
     # check if StockCategory is empty, and if so put default values in database
     if not DB.StockCategory.query.first():
         DB.db.session.add(DB.StockCategory(name="food"))
@@ -125,6 +188,30 @@ def init_database():
         DB.db.session.commit()
 
 
+@manager.command
+def migrate():
+    """Brings the schema of an existing database up to date, run this after every upgrade"""
+
+    applied = schema.migrate()
+    if not applied:
+        return "The database schema is up to date"
+    return "Applied %i migration(s):\n%s" % (len(applied), "\n".join(applied))
+
+
+@manager.command
+def explain_hot_queries():
+    """Shows the query plan of the hot queries and fails if any of them does a full table or index scan"""
+
+    if schema.pending_migrations():
+        print "The database schema is out of date, run migrate first"
+        return 1
+    lines, failures = schema.explain_hot_queries()
+    print "\n".join(lines)
+    if failures:
+        print "%i hot query(s) do a full scan: %s" % (len(failures), ", ".join(failures))
+        return 1
+
+
 @manager.command
 def seed_dummy_data():
     """Adds dummy data to the database so all features can be tested"""
@@ -137,6 +224,83 @@ def seed_dummy_data():
         activate_member(u[0])
 
 
+@manager.option('-d', '--database', dest='database', default='sqlite:///bench.db',
+                help='database to benchmark against, everything in it is dropped')
+@manager.option('-m', '--members', dest='members', type=int, default=2000)
+@manager.option('-p', '--purchases', dest='purchases', type=int, default=200000)
+@manager.option('-t', '--transactions', dest='transactions', type=int, default=20000)
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=20,
+                help='number of timed requests per url')
+@manager.option('-o', '--output', dest='output', help='write the results as JSON to this file')
+@manager.option('-c', '--compare', dest='compare', help='compare the results with a JSON file from --output')
+@manager.option('--reuse', dest='reuse', action='store_true',
+                help='reuse the dataset of a previous run instead of seeding a new one')
+def bench(database, members, purchases, transactions, repeat, output, compare, reuse):
+    """Times the hot paths against a synthetic dataset and reports p50/p95 latency and query counts against their budget"""
+    if database == app.config['SQLALCHEMY_DATABASE_URI']:
+        return "Refusing to benchmark against the configured database, its data would be dropped"
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    if not reuse:
+        DB.db.drop_all()
+        init_database()
+        benchmark.seed(members, purchases, transactions)
+    report = {'database': database,
+              'dataset': {'members': DB.User.query.count(),
+                          'bar_log': DB.BarLog.query.count(),
+                          'transactions': DB.Transaction.query.count()},
+              'repeat': repeat,
+              'results': benchmark.run(repeat)}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    result = json.dumps(report, indent=2, sort_keys=True)
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+        result += "\n" + "\n".join(benchmark.compare(baseline['results'], report['results']))
+    over_budget = benchmark.over_budget(report['results'])
+    if over_budget:
+        result += "\n%i url(s) over their query budget:\n%s" % (len(over_budget), "\n".join(over_budget))
+    return result
+
+
+@manager.option('-d', '--database', dest='database', default='sqlite:///bench.db',
+                help='database to load, seeded with a small dataset if it has no bench data yet')
+@manager.option('-n', '--terminals', dest='terminals', type=int, default=4)
+@manager.option('-s', '--sales', dest='sales', type=int, default=1000,
+                help='number of sales in the synthetic trace')
+@manager.option('--trace', dest='trace',
+                help='JSON file with a list of {"item_id": .., "user_id": ..} sales to replay instead')
+@manager.option('--password', dest='password', default=benchmark.MEMBER_PASSWORD,
+                help='password of the members in the trace')
+@manager.option('--processes', dest='processes', action='store_true',
+                help='use a process per terminal instead of a thread')
+@manager.option('--tokens', dest='tokens', action='store_true',
+                help='check balances with session tokens instead of passwords')
+@manager.option('-o', '--output', dest='output', help='write the results as JSON to this file')
+def loadtest(database, terminals, sales, trace, password, processes, tokens, output):
+    """Replays sales from concurrent bar terminals and reports throughput, latency, locks and lost sales"""
+    if database == app.config['SQLALCHEMY_DATABASE_URI']:
+        return "Refusing to load test the configured database, it would be filled with test sales"
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    DB.db.create_all()
+    if not DB.User.query.filter_by(email=benchmark.BENCH_EMAIL).first():
+        DB.db.drop_all()
+        init_database()
+        benchmark.seed(members=200, purchases=10000, transactions=2000)
+    if trace:
+        with open(trace) as f:
+            trace = [(sale.get('user_id'), sale['item_id']) for sale in json.load(f)]
+    else:
+        trace = benchmark.synthetic_trace(sales)
+    report = benchmark.load(trace, terminals, processes, password, tokens)
+    report['database'] = database
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return json.dumps(report, indent=2, sort_keys=True)
+
+
 @manager.command
 def rundebug():
     app.debug = True